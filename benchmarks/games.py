@@ -0,0 +1,262 @@
+"""
+Seeded synthetic games, for benchmarks that need realistic histories.
+
+Each game is played forwards with the replay engine, so every record is one the views
+could have written: epidemics drawn from the epidemic stack as often as the game's own
+risk says, exiles from the discard pile (and, with funding, cities removed from the
+game), forecasts of the top cards, monitor actions that sometimes skip an epidemic,
+and infections drawn from the top of the deck, hollow men and all. Games end when the
+infection deck runs out, or early while the player deck still has a couple of turns
+left in it, and there are never more epidemics than the infection rates go up to.
+"""
+
+import random
+from collections import Counter, namedtuple
+
+import sqlalchemy as sa
+
+from pandemic import constants as c
+from pandemic.main.engine import Replay, TurnRecord, game_state
+from pandemic.models import (
+    Character,
+    City,
+    CityExile,
+    CityForecast,
+    CityInfection,
+    Game,
+    PlayerSession,
+    Turn,
+    epidemics,
+)
+from pandemic.registry import hollow_men_id
+
+# `turns` is a list of TurnRecords, one per finished turn from the setup turn on
+SyntheticGame = namedtuple("SyntheticGame", "funding_rate characters turns")
+
+
+def draw_infections(rng, stack, rate):
+    """
+    `rate` cities (plus any hollow men on the way) from the top of the deck, or None
+    if there aren't that many left to draw
+    """
+    infections = Counter()
+    infected = 0
+    for i in range(1, stack.max_stack + 1):
+        cards = stack.elements(i)
+        rng.shuffle(cards)
+        for city in cards:
+            if infected == rate:
+                return infections
+            infections[city] += 1
+            infected += city != hollow_men_id
+
+    return infections if infected == rate else None
+
+
+def draw_epidemics(rng, stack, game_state, remaining):
+    """The epidemic cities drawn this turn, at most `remaining` of them"""
+    epi_risk = game_state["epi_risk"]
+    if epi_risk == 0.0:
+        return []
+
+    roll = rng.random()
+    n = (roll < epi_risk) + (roll < epi_risk - 1.0)
+    cities = []
+    for _ in range(min(n, remaining)):
+        candidates = stack.elements(stack.epidemic_stack)
+        if not candidates:
+            break
+        city = rng.choice(candidates)
+        stack.epidemic(city)
+        cities.append(city)
+
+    return cities
+
+
+def play_turn(rng, replay, turn_num, funding_rate, deck_size, rates):
+    """
+    A random but valid record for the next turn, or None if the game is over.
+    `deck_size` is the size of the player deck after setup.
+    """
+    # keeping back the turn the game is left on, and the draw after that its
+    # infection step's risks look ahead to
+    cards_left = deck_size - max(0, replay.ps_cards_drawn) - 2 * c.draw
+    if turn_num > -1 and cards_left < c.draw:
+        return None
+
+    # the state before this turn's cards are drawn
+    state = game_state(replay, 0, turn_num, funding_rate, draw_phase=False)
+    stack = replay.stack.copy()
+
+    monitor = skipped_epi = 0
+    epidemic = exiled = forecasts = []
+    if turn_num > -1:
+        if rng.random() < rates["monitor"] and cards_left >= c.draw + c.monitor:
+            monitor = 1
+            skipped_epi = int(state["epidemic_pending"] and rng.random() < 0.5)
+
+        if not skipped_epi:
+            epidemic = draw_epidemics(
+                rng, stack, state, len(c.infection_rates) - 2 - replay.epidemics
+            )
+
+        # into box six from the draw page, and out of the game with funding. A turn
+        # exiles each city at most once, its record is keyed by city
+        exiled = []
+        for to_stack in [-6, -1] if funding_rate else [-6]:
+            discards = [
+                city
+                for i in range(len(epidemic) + 1)
+                for city in stack.elements(i)
+                if city != hollow_men_id
+                and all(city != other for other, _, _ in exiled)
+            ]
+            if discards and rng.random() < rates["exile"]:
+                city = rng.choice(discards)
+                stack.exile(city, 1, len(epidemic), to_stack)
+                exiled.append((city, 1, to_stack))
+
+        if funding_rate and rng.random() < rates["forecast"]:
+            top = []
+            for i in range(1, stack.max_stack + 1):
+                cards = stack.elements(i)
+                rng.shuffle(cards)
+                top.extend(cards[: 8 - len(top)])
+                if len(top) == 8:
+                    break
+            forecasts = [(city, j + 1) for j, city in enumerate(top)]
+            stack.forecast(forecasts)
+
+    epidemics_after = replay.epidemics + len(epidemic)
+    if funding_rate and turn_num > -1 and rng.random() < rates["quiet_night"]:
+        infections = Counter()
+    else:
+        rate = c.infection_rates[epidemics_after if turn_num > -1 else -1]
+        infections = draw_infections(
+            rng, stack, rate + (c.setup_men if turn_num == -1 else 0)
+        )
+        if infections is None:
+            return None
+
+    return TurnRecord(
+        turn_num=turn_num,
+        monitor=monitor,
+        skipped_epi=skipped_epi,
+        epidemic=epidemic,
+        exiled=exiled,
+        forecasts=forecasts,
+        infections=dict(infections),
+    )
+
+
+def synthetic_game(
+    rng, turns, monitor=0.05, exile=0.1, forecast=0.05, quiet_night=0.02
+):
+    """
+    A game of up to `turns` turns after setup. The keyword arguments are the chances
+    per turn of a monitor action, of each kind of exile, of a forecast and of
+    skipping the infections.
+    """
+    rates = dict(
+        monitor=monitor, exile=exile, forecast=forecast, quiet_night=quiet_night
+    )
+    funding_rate = rng.randint(0, 3)
+    characters = rng.sample([ch.name for ch in c.characters], c.num_players)
+
+    replay = Replay.start(0)
+    deck_size = game_state(replay, 0, -1, funding_rate)["deck_size"]
+    records = []
+    for turn_num in range(-1, turns):
+        record = play_turn(rng, replay, turn_num, funding_rate, deck_size, rates)
+        if record is None:
+            break
+
+        warnings = replay.play(record)
+        assert not warnings, (turn_num, warnings)
+        records.append(record)
+
+    return SyntheticGame(funding_rate, characters, records)
+
+
+def synthetic_games(seed, games, turns, **rates):
+    rng = random.Random(seed)
+    return [synthetic_game(rng, turns, **rates) for _ in range(games)]
+
+
+def load(connection, games):
+    """
+    Write games to a database that has its cities and characters, each left on the
+    draw step of the turn after its last, as the infection step leaves them.
+    Returns the new games' ids.
+    """
+    city_ids = dict(connection.execute(sa.select(City.name, City.id)).all())
+    character_ids = dict(
+        connection.execute(sa.select(Character.name, Character.id)).all()
+    )
+
+    def db_city(city):
+        return city_ids[c.cities[city].name]
+
+    game_ids = []
+    for game in games:
+        game_id = connection.execute(
+            sa.insert(Game).values(
+                funding_rate=game.funding_rate, turn_num=len(game.turns) - 1
+            )
+        ).inserted_primary_key[0]
+        game_ids.append(game_id)
+
+        connection.execute(
+            sa.insert(PlayerSession),
+            [
+                dict(
+                    game_id=game_id,
+                    char_id=character_ids[name],
+                    turn_num=i,
+                    color_index=i,
+                )
+                for i, name in enumerate(game.characters)
+            ],
+        )
+
+        turn_ids = {}
+        for record in game.turns + [None]:
+            turn_num = len(game.turns) - 1 if record is None else record.turn_num
+            turn_ids[turn_num] = connection.execute(
+                sa.insert(Turn).values(
+                    game_id=game_id,
+                    turn_num=turn_num,
+                    monitor=record.monitor if record else 0,
+                    skipped_epi=record.skipped_epi if record else 0,
+                )
+            ).inserted_primary_key[0]
+
+        rows = dict(infections=[], exiles=[], forecasts=[], epidemics=[])
+        for record in game.turns:
+            turn_id = turn_ids[record.turn_num]
+            rows["infections"] += [
+                dict(turn_id=turn_id, city_id=db_city(city), count=n)
+                for city, n in record.infections.items()
+            ]
+            rows["exiles"] += [
+                dict(turn_id=turn_id, city_id=db_city(city), count=n, to_stack=to)
+                for city, n, to in record.exiled
+            ]
+            rows["forecasts"] += [
+                dict(turn_id=turn_id, city_id=db_city(city), stack_order=order)
+                for city, order in record.forecasts
+            ]
+            rows["epidemics"] += [
+                dict(turn_id=turn_id, city_id=db_city(city)) for city in record.epidemic
+            ]
+
+        for table, name in (
+            (CityInfection.__table__, "infections"),
+            (CityExile.__table__, "exiles"),
+            (CityForecast.__table__, "forecasts"),
+            (epidemics, "epidemics"),
+        ):
+            if rows[name]:
+                connection.execute(table.insert(), rows[name])
+
+    return game_ids
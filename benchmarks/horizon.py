@@ -0,0 +1,99 @@
+"""
+Benchmark of the exact multi-turn horizon in horizon.py, merging states against the
+naive enumeration of every path.
+
+Samples draw step game states from seeded synthetic games (see games.py), checks the
+two agree to within 1e-12 over the turns where enumerating is feasible, then times
+the merged version out to the longer horizon, as the API runs it. Run from the
+repository root with `python -m benchmarks.horizon`.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from benchmarks.games import synthetic_games
+from pandemic.main.engine import Replay, game_state
+from pandemic.main.horizon import horizon
+
+
+def game_states(games, states, rng):
+    """`states` of the games' draw step states, picked at random"""
+    candidates = []
+    for game in games:
+        replay = Replay.start(len(game.turns) - 1)
+        for turn in game.turns:
+            replay.play(turn)
+            candidates.append((replay.copy(), turn.turn_num + 1, game.funding_rate))
+
+    return [
+        game_state(replay, 0, turn_num, funding_rate, draw_phase=True)
+        for replay, turn_num, funding_rate in rng.sample(candidates, states)
+    ]
+
+
+def timed(game_states, **kwargs):
+    results = []
+    times = []
+    for state in game_states:
+        start = time.perf_counter()
+        results.append(horizon(state, **kwargs))
+        times.append(time.perf_counter() - start)
+    return results, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--states", type=int, default=45)
+    parser.add_argument("--naive-horizon", type=int, default=1)
+    parser.add_argument("--horizon", type=int, default=3)
+    parser.add_argument("--max-states", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    states = game_states(
+        synthetic_games(args.seed, args.games, args.turns),
+        args.states,
+        random.Random(args.seed),
+    )
+
+    for turns in range(1, args.horizon + 1):
+        merged, times = timed(states, turns=turns, threshold=0.0)
+        peak = max(result["states"] for result in merged)
+        print(
+            f"{turns} turns,  merged: {statistics.median(times) * 1e3:8.1f} ms median,"
+            f" {max(times) * 1e3:8.1f} ms max, {peak} states"
+        )
+
+        if turns <= args.naive_horizon:
+            naive, times = timed(states, turns=turns, threshold=0.0, merge=False)
+            peak = max(result["states"] for result in naive)
+            print(
+                f"{turns} turns,   naive: {statistics.median(times) * 1e3:8.1f} ms"
+                f" median, {max(times) * 1e3:8.1f} ms max, {peak} states"
+            )
+
+            diff = max(
+                abs(p - q)
+                for a, b in zip(merged, naive)
+                for p, q in zip(
+                    list(a["p_infected"].values()) + a["hollow_men"],
+                    list(b["p_infected"].values()) + b["hollow_men"],
+                )
+            )
+            print(f"max difference: {diff:.3g}")
+            assert diff < 1e-12
+
+        pruned, times = timed(states, turns=turns, max_states=args.max_states)
+        dropped = max(result["dropped"] for result in pruned)
+        print(
+            f"{turns} turns,  pruned: {statistics.median(times) * 1e3:8.1f} ms median,"
+            f" {max(times) * 1e3:8.1f} ms max, {dropped:.2g} dropped"
+        )
+
+
+if __name__ == "__main__":
+    main()
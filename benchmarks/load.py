@@ -0,0 +1,378 @@
+"""
+Load test of many tables playing at once against one server.
+
+Starts the app on a local port, backed by a scratch SQLite database or by an empty
+database given with `--database` (such as a local Postgres), and has `--tables`
+threads each play a game through the pages the way a table's device does: begin,
+then draw, removecity (resilient population), forecast and infect every turn, fetching
+each form for its CSRF token and picking valid cards from the JSON state. Reports
+latency percentiles per route, throughput, and database lock contention: how long
+write statements took and how many failed on a lock. Run from the repository root
+with `python -m benchmarks.load --tables 8`.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+
+from sqlalchemy import event
+from werkzeug.serving import make_server
+
+from pandemic import constants as c, create_app, db, init_db
+from pandemic.main.stack import InfectionStack
+from config import Config, config
+
+from benchmarks.games import draw_epidemics, draw_infections
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]* value="([^"]+)"')
+GAME_ID = re.compile(r'name="game"[^>]* value="(\d+)"')
+
+# errors a database gives when a statement couldn't get (or gave up waiting for) a lock
+LOCK_ERRORS = ("database is locked", "deadlock", "could not serialize", "lock timeout")
+
+
+def create_load_app(database_uri, outlook_turns):
+    class LoadConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        SQLALCHEMY_RECORD_QUERIES = False
+        OUTLOOK_TURNS = outlook_turns
+
+    config["load"] = LoadConfig
+    return create_app("load")
+
+
+class DatabaseStats:
+    """Times the write statements run on `engine`, and counts lock errors"""
+
+    def __init__(self, engine):
+        self.writes = []
+        self.lock_errors = 0
+        event.listen(engine, "before_cursor_execute", self.before)
+        event.listen(engine, "after_cursor_execute", self.after)
+        event.listen(engine, "handle_error", self.error)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_start"] = time.perf_counter()
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self.writes.append(time.perf_counter() - conn.info["statement_start"])
+
+    def error(self, context):
+        if any(error in str(context.original_exception) for error in LOCK_ERRORS):
+            self.lock_errors += 1
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # each page is timed on its own, so the tables follow redirects themselves
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Table:
+    """The players at one table, playing a game from start to finish"""
+
+    def __init__(self, base_url, rng, turns, rates):
+        self.base_url = base_url
+        self.rng = rng
+        self.turns = turns
+        self.rates = rates
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect
+        )
+        self.latencies = {}
+        self.errors = []
+        self.turns_played = 0
+
+        self.characters = rng.sample([ch.name for ch in c.characters], c.num_players)
+        self.funding_rate = rng.randint(0, 3)
+        self.game_id = None
+        self.epidemics = 0
+
+    def request(self, path, data=None, expect=200):
+        """The response's status, body and redirect location, timed by route"""
+        body = None if data is None else urllib.parse.urlencode(data, doseq=True)
+        route = ("POST " if data is not None else "GET ") + re.sub(
+            r"/\d+", "", urllib.parse.urlsplit(path).path
+        )
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(
+                self.base_url + path, body and body.encode()
+            ) as response:
+                status, text, location = response.status, response.read(), None
+        except urllib.error.HTTPError as e:
+            status, text, location = e.code, e.read(), e.headers.get("Location")
+        self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+
+        if status != expect:
+            raise RuntimeError(f"{route}: {status}, expected {expect}")
+        return text.decode(), location
+
+    def form(self, path):
+        """Load a form, for its CSRF token"""
+        page, _ = self.request(path)
+        token = CSRF_TOKEN.search(page)
+        # the infection form reorders its fields without the token, and doesn't
+        # check for one either
+        return dict(csrf_token=token.group(1)) if token else {}
+
+    def submit(self, path, data):
+        data = dict(self.form(path), game=self.game_id, **data)
+        _, location = self.request(path, data, expect=302)
+        return urllib.parse.urlsplit(location).path
+
+    def state(self, phase="draw"):
+        text, _ = self.request(f"/api/game/{self.game_id}/state?phase={phase}")
+        state = json.loads(text)
+        state["stack"] = InfectionStack.from_dict(state["stack"])
+        return state
+
+    def authorize(self):
+        # forms.auth_valid wants every player's say-so
+        return self.characters
+
+    def begin(self):
+        data = dict(self.form("/"), funding_rate=self.funding_rate)
+        for i, name in enumerate(self.characters):
+            data.update(
+                {
+                    f"players-{i}-turn_num": i,
+                    f"players-{i}-character": name,
+                    f"players-{i}-color_index": i,
+                }
+            )
+        self.request("/", data, expect=302)
+
+        page, _ = self.request("/draw")
+        self.game_id = int(GAME_ID.search(page).group(1))
+
+    def draw(self, turn_num):
+        state = self.state()
+        if turn_num > -1 and state["deck_size"] < 2 * c.draw:
+            return None
+
+        data = {}
+        if turn_num > -1:
+            data.update({"monitor-monitor_count": 0, "monitor-epidemics_seen": 0})
+
+            stack = state["stack"].copy()
+            epidemic = draw_epidemics(
+                self.rng, stack, state, len(c.infection_rates) - 2 - self.epidemics
+            )
+            self.epidemics += len(epidemic)
+            if state["epi_risk"] > 0.0:
+                data["epidemic"] = c.cities[epidemic[0]].name if epidemic else ""
+            if state["epi_risk"] > 1.0:
+                data["second_epidemic"] = (
+                    c.cities[epidemic[1]].name if len(epidemic) > 1 else ""
+                )
+
+            if self.funding_rate and self.rng.random() < self.rates["exile"]:
+                data["resilient_population"] = self.authorize()
+            if self.funding_rate and self.rng.random() < self.rates["forecast"]:
+                data["city_forecast"] = self.authorize()
+
+        return self.submit("/draw", data)
+
+    def removecity(self, path):
+        max_stack = int(path.split("/")[2])
+        stack = self.state()["stack"]
+        cities = [
+            c.cities[city].name
+            for i in range(max_stack + 1)
+            for city in stack.elements(i)
+            if c.cities[city] != c.hollow_men
+        ]
+        return self.submit(
+            path, {"cities": self.rng.sample(cities, min(1, len(cities)))}
+        )
+
+    def forecast(self):
+        stack = self.state("infect")["stack"]
+        top = []
+        for i in range(1, stack.max_stack + 1):
+            cards = stack.elements(i)
+            self.rng.shuffle(cards)
+            top.extend(cards[: 8 - len(top)])
+
+        data = {}
+        for j, city in enumerate(top[:8]):
+            data[f"forecast_cities-{j}-stack_order"] = j
+            data[f"forecast_cities-{j}-city_name"] = c.cities[city].name
+        return self.submit("/forecast", data)
+
+    def infect(self, turn_num):
+        if (
+            turn_num > -1
+            and self.funding_rate
+            and self.rng.random() < self.rates["quiet_night"]
+        ):
+            return self.submit("/infect", {"skip_infection": self.authorize()})
+
+        rate = c.infection_rates[self.epidemics if turn_num > -1 else -1]
+        infections = draw_infections(
+            self.rng,
+            self.state("infect")["stack"],
+            rate + (c.setup_men if turn_num == -1 else 0),
+        )
+        if infections is None:
+            # the infection deck ran out, and the game with it
+            return None
+
+        cities = [
+            c.cities[city].name for city, n in infections.items() for _ in range(n)
+        ]
+        return self.submit("/infect", {"cities": cities})
+
+    def play(self):
+        try:
+            self.begin()
+            for turn_num in range(-1, self.turns):
+                path = self.draw(turn_num)
+                if path is None:
+                    break
+
+                while path.startswith("/removecity"):
+                    path = self.removecity(path)
+                if path == "/forecast":
+                    path = self.forecast()
+                if self.infect(turn_num) is None:
+                    break
+                self.turns_played += 1
+        except Exception as e:
+            self.errors.append(f"game {self.game_id}: {e}")
+
+
+def percentiles(times):
+    if not times:
+        return dict(n=0, p50=0.0, p90=0.0, p99=0.0, max=0.0)
+    q = statistics.quantiles(
+        times * 2 if len(times) == 1 else times, n=100, method="inclusive"
+    )
+    return dict(n=len(times), p50=q[49], p90=q[89], p99=q[98], max=max(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tables", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--database", help="URI of an empty database (default: a scratch SQLite file)"
+    )
+    parser.add_argument(
+        "--outlook-turns",
+        type=int,
+        default=Config.OUTLOOK_TURNS,
+        help="turns of Monte Carlo outlook on the draw page (0 to turn it off)",
+    )
+    parser.add_argument(
+        "--output", help="write the results as JSON here (- for stdout)"
+    )
+    args = parser.parse_args()
+
+    out = sys.stderr if args.output == "-" else sys.stdout
+    # one line per request would drown out the report
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    rates = dict(exile=0.1, forecast=0.05, quiet_night=0.02)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        database = args.database or "sqlite:///" + os.path.join(scratch, "load.sqlite")
+        app = create_load_app(database, args.outlook_turns)
+        with app.app_context():
+            init_db()
+            db_stats = DatabaseStats(db.engine)
+            dialect = db.engine.dialect.name
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+        rng = random.Random(args.seed)
+        tables = [
+            Table(base_url, random.Random(rng.random()), args.turns, rates)
+            for _ in range(args.tables)
+        ]
+        threads = [threading.Thread(target=table.play) for table in tables]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        server.shutdown()
+        with app.app_context():
+            db.engine.dispose()
+
+    latencies = {}
+    for table in tables:
+        for route, times in table.latencies.items():
+            latencies.setdefault(route, []).extend(times)
+
+    requests = sum(len(times) for times in latencies.values())
+    turns = sum(table.turns_played for table in tables)
+    report = dict(
+        database=dialect,
+        args=vars(args),
+        seconds=elapsed,
+        requests=requests,
+        requests_per_second=requests / elapsed,
+        turns_per_second=turns / elapsed,
+        routes={
+            route: percentiles(times) for route, times in sorted(latencies.items())
+        },
+        writes=percentiles(db_stats.writes),
+        lock_errors=db_stats.lock_errors,
+        errors=[error for table in tables for error in table.errors],
+    )
+
+    print(
+        f"{args.tables} tables, {turns} turns and {requests} requests in"
+        f" {elapsed:.1f} s: {report['requests_per_second']:.1f} requests/s,"
+        f" {report['turns_per_second']:.2f} turns/s",
+        file=out,
+    )
+    print(
+        f"\n{'':24} {'n':>6} {'p50':>10} {'p90':>10} {'p99':>10} {'max':>10}", file=out
+    )
+    for route, result in list(report["routes"].items()) + [
+        ("database writes", report["writes"])
+    ]:
+        print(
+            f"{route:24} {result['n']:6d}"
+            + "".join(
+                f" {result[p] * 1e3:7.1f} ms" for p in ("p50", "p90", "p99", "max")
+            ),
+            file=out,
+        )
+    print(f"\nlock errors: {report['lock_errors']}", file=out)
+    for error in report["errors"]:
+        print(error, file=out)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Benchmark suite for the cost of working out and showing a game's state.
+
+Generates seeded synthetic games (see benchmarks/games.py), loads them into a scratch
+SQLite database and times, per game: replaying the turns with the engine, the risk
+calculations on the final stack, `get_game_state` replaying from the database with no
+snapshots, and rendering the game's pages through the Flask test client (with the
+state cache cleared first, as after a write, and the snapshots in place). Results are
+seconds per call, printed as a table and optionally written as JSON, which a later run
+can `--compare` against. Run from the repository root with
+`python -m benchmarks.suite --output before.json`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from pandemic import constants as c, create_app, db, init_db
+from pandemic.main import risk
+from pandemic.main.engine import Replay, game_state, replay
+from pandemic.main.state import (
+    compute_game_state,
+    game_states,
+    get_game_state,
+    save_snapshots,
+)
+from pandemic.models import Game, StackSnapshot, Turn
+from config import TestingConfig, config
+
+from benchmarks.games import load, synthetic_games
+
+ROUTES = [
+    "/draw/{game_id}",
+    "/infect/{game_id}",
+    "/history/{game_id}",
+    "/api/game/{game_id}/state",
+    "/history",
+]
+
+
+def create_benchmark_app(path):
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + path
+        SQLALCHEMY_RECORD_QUERIES = False
+        # just the request itself, with nothing left running in the background
+        OUTLOOK_TURNS = 0
+        PRECOMPUTE_WORKERS = 0
+        SPECULATE_BUDGET = 0
+
+    config["benchmark"] = BenchmarkConfig
+    return create_app("benchmark")
+
+
+def timed(fn, items, repeat, setup=None):
+    """
+    Seconds per call of `fn(item)`, for each item `repeat` times over. `setup(item)`
+    is called before each, outside the timing.
+    """
+    times = []
+    for _ in range(repeat):
+        for item in items:
+            if setup is not None:
+                setup(item)
+            start = time.perf_counter()
+            fn(item)
+            times.append(time.perf_counter() - start)
+
+    return times
+
+
+def summary(times):
+    return dict(
+        median=statistics.median(times),
+        mean=statistics.fmean(times),
+        min=min(times),
+        n=len(times),
+    )
+
+
+def engine_benchmarks(games, repeat):
+    def replayed(game):
+        return replay(game.turns, Replay.start(len(game.turns) - 1))[0]
+
+    finals = [replayed(game) for game in games]
+
+    # the risk functions' arguments for each final stack, as game_state works them out
+    risk_args = []
+    for final in finals:
+        stack = final.stack
+        epi_stack = stack.epidemic_stack
+        epidemic_risk = min(
+            1.0, game_state(final, 0, 0, 0, draw_phase=False)["epi_risk"]
+        )
+        epi_risk = defaultdict(
+            float,
+            {city: n / stack.size(epi_stack) for city, n in stack.items(epi_stack)},
+        )
+        risk_args.append(
+            (
+                (stack, c.infection_rates[final.epidemics], 1.0 - epidemic_risk),
+                (
+                    stack,
+                    c.infection_rates[final.epidemics + 1],
+                    epidemic_risk,
+                    epi_risk,
+                ),
+            )
+        )
+
+    return {
+        "replay": timed(replayed, games, repeat),
+        "game_state": timed(
+            lambda final: game_state(final, 0, 0, 0, draw_phase=False), finals, repeat
+        ),
+        "infection_risk": timed(
+            lambda args: risk.infection_risk(*args[0]), risk_args, repeat
+        ),
+        "epi_infection_risk": timed(
+            lambda args: risk.epi_infection_risk(*args[1]), risk_args, repeat
+        ),
+    }
+
+
+def app_benchmarks(app, game_ids, repeat):
+    results = {}
+
+    def forget(game_id):
+        # drop the cached state and any snapshots the last call saved
+        db.session.execute(
+            StackSnapshot.__table__.delete().where(
+                StackSnapshot.turn_id.in_(
+                    db.select(Turn.id).where(Turn.game_id == game_id)
+                )
+            )
+        )
+        db.session.commit()
+        game_states.invalidate(game_id)
+
+    with app.test_request_context():
+        # without snapshots, so every turn is replayed
+        results["get_game_state"] = timed(
+            lambda game_id: get_game_state(db.session.get(Game, game_id)),
+            game_ids,
+            repeat,
+            setup=forget,
+        )
+        db.session.rollback()
+
+        # then as the infection step leaves things, with the finished turns' snapshots
+        for game_id in game_ids:
+            snapshots = []
+            compute_game_state(db.session.get(Game, game_id), True, snapshots)
+            save_snapshots(snapshots)
+
+    client = app.test_client()
+
+    def get(url):
+        def request(game_id):
+            response = client.get(url.format(game_id=game_id))
+            assert response.status_code == 200, (url, game_id, response.status_code)
+
+        return request
+
+    for url in ROUTES:
+        results["GET " + url] = timed(
+            get(url), game_ids, repeat, setup=game_states.invalidate
+        )
+
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after, out):
+    print(f"\n{'':32} {'before':>10} {'after':>10} {'ratio':>7}", file=out)
+    for name, result in after["results"].items():
+        if name in before["results"]:
+            old = before["results"][name]["median"]
+            new = result["median"]
+            print(
+                f"{name:32} {old * 1e3:7.3f} ms {new * 1e3:7.3f} ms {new / old:7.2f}",
+                file=out,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--games", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", help="write the results as JSON here (- for stdout)"
+    )
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    out = sys.stderr if args.output == "-" else sys.stdout
+    games = synthetic_games(args.seed, args.games, args.turns)
+    results = engine_benchmarks(games, args.repeat)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        app = create_benchmark_app(os.path.join(scratch, "bench.sqlite"))
+        with app.app_context():
+            init_db()
+            with db.engine.begin() as connection:
+                game_ids = load(connection, games)
+
+        results.update(app_benchmarks(app, game_ids, args.repeat))
+
+        with app.app_context():
+            db.engine.dispose()
+
+    report = dict(
+        commit=commit(),
+        python=platform.python_version(),
+        args=vars(args),
+        turns=statistics.fmean(len(game.turns) for game in games),
+        results={name: summary(times) for name, times in results.items()},
+    )
+
+    print(f"{'':32} {'median':>10} {'min':>10}", file=out)
+    for name, result in report["results"].items():
+        print(
+            f"{name:32} {result['median'] * 1e3:7.3f} ms {result['min'] * 1e3:7.3f} ms",
+            file=out,
+        )
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report, out)
+
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
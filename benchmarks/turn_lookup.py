@@ -0,0 +1,151 @@
+"""
+Benchmark of the turn lookups every request makes, before and after the indexes that
+`flask upgradedb` adds.
+
+For each database size, seeds a scratch SQLite database with that many games without
+the indexes, times looking up a game's current turn (as `check_game_id` does) and
+loading its turn history (as `get_game_state` does), then upgrades the database and
+times them again. Run from the repository root with
+`python -m benchmarks.turn_lookup`.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session, selectinload
+
+from pandemic import constants as c, db, schema
+from pandemic.models import (
+    City,
+    CityExile,
+    CityForecast,
+    CityInfection,
+    Game,
+    Turn,
+    epidemics,
+)
+
+
+def seed(engine, rng, games, turns):
+    """`games` games of `turns` turns each, with a few infections and epidemics"""
+    db.metadata.create_all(engine)
+    # drop the indexes, to start from a database made before they were declared
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+    n_cities = len(c.cities)
+    with engine.begin() as connection:
+        connection.execute(
+            sa.insert(City),
+            [
+                dict(
+                    id=i + 1,
+                    name=city.name,
+                    color=city.color,
+                    player_cards=city.player_cards,
+                    infection_cards=city.infection_cards,
+                )
+                for i, city in enumerate(c.cities)
+            ],
+        )
+        connection.execute(
+            sa.insert(Game),
+            [
+                dict(id=g, funding_rate=2, turn_num=turns - 1)
+                for g in range(1, games + 1)
+            ],
+        )
+
+        # interleave the games' turns, as they'd be with several tables playing
+        turn_rows = [
+            dict(id=t * games + g, game_id=g, turn_num=t - 1, monitor=0, skipped_epi=0)
+            for t in range(turns)
+            for g in range(1, games + 1)
+        ]
+        connection.execute(sa.insert(Turn), turn_rows)
+
+        infections, epidemic_rows = [], []
+        for turn in turn_rows:
+            for city in rng.sample(range(1, n_cities + 1), 3):
+                infections.append(dict(turn_id=turn["id"], city_id=city, count=1))
+            if rng.random() < 0.1:
+                epidemic_rows.append(
+                    dict(turn_id=turn["id"], city_id=rng.randint(1, n_cities))
+                )
+
+        connection.execute(sa.insert(CityInfection), infections)
+        connection.execute(epidemics.insert(), epidemic_rows)
+
+
+def current_turn(session, game_id, turn_num):
+    return session.scalars(
+        sa.select(Turn).filter_by(game_id=game_id, turn_num=turn_num)
+    ).one_or_none()
+
+
+def turn_history(session, game_id):
+    return session.scalars(
+        sa.select(Turn)
+        .filter(Turn.game_id == game_id)
+        .options(
+            selectinload(Turn.epidemic),
+            selectinload(Turn.exiled).joinedload(CityExile.city),
+            selectinload(Turn.forecasts).joinedload(CityForecast.city),
+            selectinload(Turn.infections).joinedload(CityInfection.city),
+        )
+        .order_by(Turn.turn_num)
+    ).all()
+
+
+def timed(engine, lookup, game_ids, *args):
+    """Median seconds per lookup, each in a fresh session"""
+    times = []
+    for game_id in game_ids:
+        with Session(engine) as session:
+            start = time.perf_counter()
+            lookup(session, game_id, *args)
+            times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--games", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'games':>6} {'indexes':>8} {'current turn':>13} {'turn history':>13}")
+    for games in args.games:
+        rng = random.Random(args.seed)
+        with tempfile.TemporaryDirectory() as scratch:
+            engine = sa.create_engine(
+                "sqlite:///" + os.path.join(scratch, "bench.sqlite")
+            )
+            seed(engine, rng, games, args.turns)
+            game_ids = [rng.randint(1, games) for _ in range(args.lookups)]
+
+            for indexes in ("before", "after"):
+                if indexes == "after":
+                    schema.upgrade(engine)
+
+                t_turn = timed(engine, current_turn, game_ids, args.turns - 1)
+                t_history = timed(engine, turn_history, game_ids)
+                print(
+                    f"{games:6d} {indexes:>8} {t_turn * 1e3:10.3f} ms"
+                    f" {t_history * 1e3:10.3f} ms"
+                )
+
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,53 @@ class Config:
     MAIL_USE_TLS = True
     MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    # worker processes for the speculation and the outlook, which share them (None
+    # for one per cpu)
+    WORKER_PROCESSES = None
+    # Monte Carlo outlook, which the draw page fetches from /api/game/<id>/outlook:
+    # turns ahead (0 to turn it off), the most seconds to spend sampling, the
+    # standard error to stop at once every probability is within it, and batches to
+    # sample at once in the worker processes (None for one per process, 0 to sample
+    # in the request's process instead)
+    OUTLOOK_TURNS = 3
+    OUTLOOK_TIME_BUDGET = 0.2
+    OUTLOOK_TOLERANCE = 0.01
+    OUTLOOK_WORKERS = None
+    # exact infection risks at /api/game/<id>/horizon: the most turns ahead it can
+    # be asked for (0 to turn it off) and the most states to follow at once (None
+    # for no cap, the least likely are dropped past it)
+    HORIZON_TURNS = 3
+    HORIZON_MAX_STATES = 1000
+    # threads that work out the next turn's state after the infection step (0 to
+    # compute it when the draw page asks for it instead)
+    PRECOMPUTE_WORKERS = 1
+    # speculative infection step states while on the draw page: how many to hold at
+    # once over all games (0 to turn it off)
+    SPECULATE_BUDGET = 256
+    # what passes state change notices to the event streams, and how often (in
+    # seconds) an idle stream sends something to stay open
+    EVENT_BROKER = "pandemic.main.events.LocalBroker"
+    EVENT_KEEPALIVE = 15
+    # games per page of the history listing
+    HISTORY_PAGE_SIZE = 50
+    # time the phases of each request (queries, replay, risk, forms and templates)
+    # for a Server-Timing header and/or an INFO line of JSON on the app's "timing"
+    # logger. Nothing is timed with both off (and METRICS off)
+    SERVER_TIMING = False
+    SERVER_TIMING_LOG = False
+    # Prometheus metrics at /metrics. Worker processes on one host can share
+    # METRICS_DIR (None for just this process): each writes its totals there at most
+    # every METRICS_FLUSH seconds, and a scrape of any of them adds them all up. A
+    # game counts as active for METRICS_ACTIVE_WINDOW seconds after a request for it
+    METRICS = False
+    METRICS_DIR = None
+    METRICS_FLUSH = 5
+    METRICS_ACTIVE_WINDOW = 900
+    # games whose replays are traced from the start (more can be started through
+    # /api/game/<id>/trace), and how many of each one's latest events to keep (0 to
+    # only log them at DEBUG)
+    TRACE_GAMES = ()
+    TRACE_EVENTS = 1000
 
     @staticmethod
     def init_app(app):
@@ -36,9 +36,13 @@ def create_app(config_name):
     db.init_app(this_app)
     nav.init_app(this_app)
 
-    from .main import main as main_blueprint
+    from .main import main as main_blueprint, metrics, pool, timing, trace
 
     this_app.register_blueprint(main_blueprint)
+    timing.init_app(this_app)
+    metrics.init_app(this_app)
+    trace.init_app(this_app)
+    pool.init_app(this_app)
 
     return this_app
 
@@ -75,9 +79,31 @@ def init_db():
     )
     db.session.commit()
 
+    from .registry import load_db_ids
+
+    load_db_ids()
+
 
 @app.cli.command("initdb")
 def initdb_command():
     """Initializes the database."""
     init_db()
     app.logger.info("Initialized the database.")
+
+
+@app.cli.command("upgradedb")
+def upgradedb_command():
+    """Adds any tables, columns and indexes an existing database is missing."""
+    from . import schema
+
+    duplicates = schema.duplicate_turns(db.engine)
+    if duplicates:
+        # the turns index is unique, so these have to be sorted out by hand first
+        raise click.ClickException(
+            "Turns recorded more than once (game, turn, count): "
+            + ", ".join(map(str, duplicates))
+        )
+
+    for name in schema.upgrade(db.engine):
+        app.logger.info(f"Created {name}")
+    app.logger.info("Upgraded the database.")
@@ -0,0 +1,97 @@
+class EpidemicBlocks:
+    """
+    The post-setup player deck, split into one block per epidemic card as evenly as
+    possible (the first `deck_size % epidemic_cards` blocks get the extra cards).
+    Each block has one epidemic somewhere in it. Everything is worked out from the
+    block sizes, rather than by laying out the cards.
+    """
+
+    def __init__(self, deck_size, epidemic_cards):
+        self.deck_size = deck_size
+        self.epidemic_cards = epidemic_cards
+        self.min_size, self.n_big = divmod(deck_size, epidemic_cards)
+
+    def size(self, block):
+        if not 0 <= block < self.epidemic_cards:
+            return 0
+        return self.min_size + (block < self.n_big)
+
+    def start(self, block):
+        """Position in the deck of the first card of `block`"""
+        return block * self.min_size + min(block, self.n_big)
+
+    def block(self, position):
+        """The block the card at `position` is in"""
+        big_cards = self.n_big * (self.min_size + 1)
+        if position < big_cards:
+            return position // (self.min_size + 1)
+        elif self.min_size:
+            return min(
+                self.n_big + (position - big_cards) // self.min_size,
+                self.epidemic_cards,
+            )
+        else:
+            return self.epidemic_cards
+
+    def remaining(self, block, drawn):
+        """Cards left in `block` after `drawn` cards"""
+        return max(0, min(self.size(block), self.start(block + 1) - drawn))
+
+    def remaining_blocks(self, drawn):
+        """The cards left in each block, from the one the next card is in"""
+        return [
+            self.remaining(block, drawn)
+            for block in range(self.block(drawn), self.epidemic_cards)
+        ]
+
+    def epidemic_risk(self, drawn, epidemics):
+        """
+        The expected number of epidemics in the next two cards (so over 1.0 means
+        one is certain), and how many cards until the one after that, given that
+        the blocks before `epidemics` have had their epidemic
+        """
+        i_block = self.block(drawn)
+        j_block = self.block(drawn + 1)
+
+        if i_block >= self.epidemic_cards:
+            # out of cards
+            return 0.0, 0
+
+        if i_block < epidemics:
+            if j_block < epidemics:
+                # this epidemic has already been drawn (and so has the next block's,
+                # if the second card is in it)
+                epidemic_risk = 0.0
+                # next epidemic is in the block after the second card's somewhere
+                epidemic_in = self.start(j_block + 1) - drawn + self.size(j_block + 1)
+            else:
+                assert self.remaining(i_block, drawn) == 1
+                # the second card could be one
+                epidemic_risk = 1.0 / self.size(j_block)
+                # next epidemic is in the next block somewhere
+                epidemic_in = self.remaining(i_block, drawn) + self.size(i_block + 1)
+        elif i_block == j_block:
+            # both are same block, and it hasn't been drawn yet
+            epidemic_in = self.remaining(i_block, drawn)
+            epidemic_risk = 2.0 / epidemic_in
+        else:
+            # first card is definitely an epidemic, second one might be!
+            assert self.remaining(i_block, drawn) == 1
+            epidemic_risk = 1.0 + 1.0 / self.size(j_block)
+            # next epidemic is... right now! and then the next block
+            epidemic_in = self.size(j_block)
+
+        return epidemic_risk, epidemic_in
+
+    def next_draws(self, drawn, epidemics, n):
+        """The probability that each of the next `n` cards is an epidemic"""
+        risks = []
+        for position in range(drawn, drawn + n):
+            block = self.block(position)
+            if epidemics <= block < self.epidemic_cards:
+                # equally likely to be any of the cards left in the block
+                risks.append(1.0 / self.remaining(block, drawn))
+            else:
+                risks.append(0.0)
+
+        return risks
@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+
+
+class GameStateCache:
+    """
+    Computed game states, kept in process memory with least-recently-used eviction.
+    Keys are (game_id, turn_num, draw_phase, version), where the version is the
+    game's own, which goes up in the same transaction as every write to its turns.
+    Stale entries are never hit (in this process or any other), and the game's
+    writers drop them to make room. One put after that (computed from the turns as
+    they were) just ages out.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, game, draw_phase):
+        return game.id, game.turn_num, draw_phase, game.version
+
+    def etag(self, key):
+        """
+        An entity tag for the state under `key`. It comes from the game's stored
+        version, so every process gives the same one, until the history changes
+        """
+        return "-".join(map(str, key))
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def peek(self, key):
+        """Like `get`, but without counting towards the stats or the eviction order"""
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, game_id):
+        """Call after committing any change to a game's turns"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == game_id]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else None,
+                size=len(self.entries),
+                maxsize=self.maxsize,
+            )
+
+
+class SpeculativeStates:
+    """
+    Game states being worked out ahead of time for the ways a turn might be recorded,
+    as futures keyed by the cache key of the state they follow on from and then by
+    outcome. At most `budget` are held at once, cancelling the oldest games'
+    speculations to make room for a new one.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def size(self):
+        return sum(len(futures) for futures in self.entries.values())
+
+    def start(self, base, outcomes, submit, budget):
+        """
+        Call `submit(outcome)` for as many `outcomes` as fit, most likely first, unless
+        the state under `base` is already being speculated on
+        """
+        with self.lock:
+            if base in self.entries:
+                # another look at the same draw page
+                self.entries.move_to_end(base)
+                return
+
+            self._cancel(base[0])
+            while self.entries and self.size() + len(outcomes) > budget:
+                _, futures = self.entries.popitem(last=False)
+                for future in futures.values():
+                    future.cancel()
+
+            outcomes = outcomes[: max(0, budget - self.size())]
+            if outcomes:
+                self.entries[base] = {outcome: submit(outcome) for outcome in outcomes}
+
+    def take(self, base, outcome):
+        """
+        The future for what actually happened (None if it wasn't speculated on).
+        Call once the turn is committed, every other outcome gets cancelled.
+        """
+        with self.lock:
+            futures = self.entries.pop(base, {})
+            future = futures.pop(outcome, None)
+            if future is None or future.cancelled():
+                self.misses += 1
+                future = None
+            else:
+                self.hits += 1
+
+        for other in futures.values():
+            other.cancel()
+        return future
+
+    def discard(self, game_id):
+        """Cancel a game's speculations, call when its history is rewritten"""
+        with self.lock:
+            self._cancel(game_id)
+
+    def _cancel(self, game_id):
+        for base in [base for base in self.entries if base[0] == game_id]:
+            for future in self.entries.pop(base).values():
+                future.cancel()
+
+    def stats(self):
+        with self.lock:
+            takes = self.hits + self.misses
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / takes if takes else None,
+                size=self.size(),
+            )
@@ -0,0 +1,263 @@
+# the replay and risk calculations, free of the database and of Flask. Turns come in
+# as plain records keyed by city ids, and anything that looks wrong with them is
+# returned as a list of warnings for the caller to show. What it does can be traced,
+# see trace.py
+
+from collections import defaultdict, namedtuple
+
+from pandemic import constants as c
+from pandemic.main.blocks import EpidemicBlocks
+from pandemic.main.risk import epi_infection_risk, infection_risk
+from pandemic.main.stack import InfectionStack
+from pandemic.main.timing import phase
+from pandemic.main.trace import tracer
+from pandemic.registry import hollow_men_id
+
+# `epidemic` is a list of city ids, `exiled` a list of (city id, count, to_stack),
+# `forecasts` a list of (city id, stack_order) and `infections` maps city id -> count
+TurnRecord = namedtuple(
+    "TurnRecord",
+    "turn_num monitor skipped_epi epidemic exiled forecasts infections",
+)
+
+# a game state and any warnings about the records, along with what it was replayed
+# from: the replay as of the end of the last finished turn, and the current turn's
+# record (None if it hasn't been started)
+ReplayResult = namedtuple("ReplayResult", "state warnings before turn")
+
+
+class Replay:
+    """The infection deck and epidemic count, as of the last turn played"""
+
+    def __init__(self, stack, epidemics, skipped_epi, ps_cards_drawn):
+        self.stack = stack
+        self.epidemics = epidemics
+        self.skipped_epi = skipped_epi
+        self.ps_cards_drawn = ps_cards_drawn
+
+    @classmethod
+    def start(cls, turn_num):
+        """The state before the setup turn, for a game that's now on `turn_num`"""
+        stack = InfectionStack()
+        for i, city in enumerate(c.cities):
+            if i == hollow_men_id:
+                stack.add(0, i, city.infection_cards)
+            else:
+                stack.add(
+                    1, i, city.infection_cards - c.infection_cards_in_box_six[city]
+                )
+                stack.add(-6, i, c.infection_cards_in_box_six[city])
+
+        # the setup turn doesn't draw any post-setup cards
+        return cls(stack, -1 if turn_num == -1 else 0, 0, -c.draw)
+
+    def copy(self):
+        return Replay(
+            self.stack.copy(), self.epidemics, self.skipped_epi, self.ps_cards_drawn
+        )
+
+    def play(self, turn):
+        """Apply one turn. Returns a list of warnings about the records"""
+        warnings = []
+        stack = self.stack
+        trace = tracer.get()
+
+        self.ps_cards_drawn += c.draw
+
+        if turn.monitor:
+            if trace is not None:
+                trace.event(
+                    turn.turn_num,
+                    "monitor",
+                    actions=turn.monitor,
+                    skipped_epi=turn.skipped_epi,
+                )
+
+            self.skipped_epi += turn.skipped_epi
+            self.ps_cards_drawn += turn.monitor * c.monitor
+
+        if turn.epidemic:
+            if trace is not None:
+                trace.event(
+                    turn.turn_num,
+                    "epidemic",
+                    cities=[c.cities[city].name for city in turn.epidemic],
+                )
+            for epidemic_city in turn.epidemic:
+                self.epidemics += 1
+                if not stack.epidemic(epidemic_city):
+                    warnings.append(
+                        "WARNING: this epidemic shouldn't be possible, check records!"
+                    )
+
+        for city, count, to_stack in turn.exiled:
+            if trace is not None:
+                trace.event(
+                    turn.turn_num,
+                    "exile",
+                    city=c.cities[city].name,
+                    count=count,
+                    to_stack=to_stack,
+                )
+
+            if not stack.exile(city, count, len(turn.epidemic), to_stack):
+                warnings.append("WARNING: Couldn't find cities in stack 0 to exile")
+
+        if turn.forecasts:
+            if trace is not None:
+                trace.event(
+                    turn.turn_num,
+                    "forecast",
+                    cities=[
+                        c.cities[city].name
+                        for city, _ in sorted(turn.forecasts, key=lambda f: f[1])
+                    ],
+                )
+            stack.forecast(turn.forecasts)
+
+        if trace is not None:
+            trace.event(
+                turn.turn_num,
+                "infect",
+                cities={
+                    c.cities[city].name: count
+                    for city, count in turn.infections.items()
+                },
+            )
+
+        if not stack.infect(stack.vector(turn.infections)):
+            warnings.append(
+                "WARNING: looks like a city was infected too early, check records!"
+            )
+
+        stack.settle()
+        return warnings
+
+
+def replay(turns, start):
+    """Play `turns` on from `start` (modified in place), returning any warnings"""
+    warnings = []
+    for turn in turns:
+        warnings.extend(start.play(turn))
+
+    return start, warnings
+
+
+def play_turn(before, turn, game_id, funding_rate, warnings=(), draw_phase=False):
+    """
+    The result of playing `turn` on from `before`, which is left as it was.
+    `warnings` are the ones from replaying up to `before`.
+    """
+    after = before.copy()
+    warnings = list(warnings) + after.play(turn)
+    return ReplayResult(
+        game_state(after, game_id, turn.turn_num, funding_rate, draw_phase),
+        warnings,
+        before,
+        turn,
+    )
+
+
+def game_state(replay, game_id, turn_num, funding_rate, draw_phase=True):
+    """The deck, epidemic and infection risks for a game whose turns are replayed"""
+    stack = replay.stack
+    epidemics = replay.epidemics
+    skipped_epi = replay.skipped_epi
+
+    city_cards = sum(city.player_cards for city in c.cities) - sum(
+        c.player_cards_in_box_six.values()
+    )
+    epidemic_cards = c.epidemics[
+        min((k for k in c.epidemics if k >= city_cards), default=-1)
+    ]
+
+    # deck size after dealing the initial hands
+    post_setup_deck_size = (
+        city_cards
+        + epidemic_cards
+        + funding_rate
+        + c.extra_cards
+        - c.num_players * c.initial_hand_size[c.num_players]
+    )
+
+    if turn_num == -1:
+        ps_cards_drawn = 0
+    elif draw_phase:
+        # the current turn's cards haven't been drawn yet
+        ps_cards_drawn = replay.ps_cards_drawn - c.draw
+    else:
+        ps_cards_drawn = replay.ps_cards_drawn
+
+    # how many cards are left
+    deck_size = post_setup_deck_size - ps_cards_drawn
+
+    blocks = EpidemicBlocks(post_setup_deck_size, epidemic_cards)
+    epidemics_seen = epidemics + skipped_epi
+
+    if turn_num > -1:
+        epidemic_risk, epidemic_in = blocks.epidemic_risk(
+            ps_cards_drawn, epidemics_seen
+        )
+    else:
+        epidemic_risk = 0.0
+        epidemic_in = blocks.size(0)
+
+    epi_stack = stack.epidemic_stack
+    epi_risk = defaultdict(
+        float,
+        {city: n / stack.size(epi_stack) for city, n in stack.items(epi_stack)},
+    )
+
+    with phase("risk"):
+        inf_risk, hollow_risk = infection_risk(
+            stack, c.infection_rates[epidemics], 1.0 - epidemic_risk
+        )
+
+        epi_inf_risk, epi_hollow_risk = epi_infection_risk(
+            stack, c.infection_rates[epidemics + 1], epidemic_risk, epi_risk
+        )
+
+    city_data = [
+        dict(
+            name=city.name,
+            color=city.color,
+            inf_risk=inf_risk[i],
+            epi_risk=epi_risk[i],
+            epi_inf_risk=epi_inf_risk[i],
+        )
+        for i, city in enumerate(c.cities)
+        if i != hollow_men_id
+    ]
+
+    trace = tracer.get()
+    if trace is not None:
+        trace.event(
+            turn_num,
+            "state",
+            city_cards=city_cards,
+            epidemic_cards=epidemic_cards,
+            deck_size=deck_size,
+            epi_risk=epidemic_risk,
+            epi_in=epidemic_in,
+            stack=stack.to_dict(),
+        )
+
+    return {
+        "game_id": game_id,
+        "turn_num": turn_num,
+        "funding": funding_rate,
+        "deck_size": deck_size,
+        "epi_risk": epidemic_risk,
+        "epi_in": epidemic_in,
+        # the chance of an epidemic in each of the next two turns' draws
+        "epi_draws": blocks.next_draws(ps_cards_drawn, epidemics_seen, 2 * c.draw),
+        # cards left in each epidemic block from the current one, which might have
+        # had its epidemic already
+        "epidemic_blocks": blocks.remaining_blocks(ps_cards_drawn),
+        "epidemic_pending": blocks.block(ps_cards_drawn) >= epidemics_seen,
+        "epidemics": epidemics,
+        "city_data": city_data,
+        "hollow_risk": hollow_risk,
+        "epi_hollow_risk": epi_hollow_risk,
+        "stack": stack,
+    }
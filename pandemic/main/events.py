@@ -0,0 +1,146 @@
+# pushing state changes to every device at a table. The views publish a small
+# notice on a game's channel after each commit, and each server-sent event stream
+# works out the new state (usually from the cache) and sends just what changed.
+#
+# The broker is in-process by default. When running more than one worker, point
+# EVENT_BROKER at a class with the same publish/subscribe/unsubscribe methods that
+# passes the notices between them (subscribe returns something with a queue.Queue
+# style `get`). They're plain dicts, so anything that can carry JSON will do
+
+import json
+import queue
+import threading
+from collections import defaultdict
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+from pandemic import db
+from pandemic.main.state import cached_game_state
+from pandemic.models import Game
+
+
+class LocalBroker:
+    """Publish/subscribe within this process, with one queue per subscriber"""
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel):
+        q = queue.Queue()
+        with self.lock:
+            self.subscribers[channel].add(q)
+        return q
+
+    def unsubscribe(self, channel, q):
+        with self.lock:
+            self.subscribers[channel].discard(q)
+            if not self.subscribers[channel]:
+                del self.subscribers[channel]
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for q in subscribers:
+            q.put(message)
+
+
+# created on first use from the config and kept for the life of the process
+broker = None
+
+
+def get_broker():
+    global broker
+    if broker is None:
+        broker = import_string(current_app.config["EVENT_BROKER"])()
+    return broker
+
+
+def channel(game_id):
+    return f"game-{game_id}"
+
+
+def publish_change(game, draw_phase):
+    """
+    Let the game's streams know its turns changed, and which step's state the
+    players are moving on to. Call after committing.
+    """
+    get_broker().publish(
+        channel(game.id),
+        dict(game_id=game.id, draw_phase=draw_phase),
+    )
+
+
+def state_summary(game_state):
+    """The parts of a game state that are sent to the devices"""
+    return dict(
+        turn_num=game_state["turn_num"],
+        deck_size=game_state["deck_size"],
+        epi_risk=game_state["epi_risk"],
+        hollow_risk=game_state["hollow_risk"],
+        cities={
+            city["name"]: [city["inf_risk"], city["epi_risk"], city["epi_inf_risk"]]
+            for city in game_state["city_data"]
+        },
+        stack={str(i): cities for i, cities in game_state["stack"].to_dict().items()},
+    )
+
+
+def state_diff(old, new):
+    """
+    What changed between two summaries: the same keys, with only the cities and
+    stacks that changed (stacks that emptied out come back as null)
+    """
+    diff = {}
+    for key, value in new.items():
+        if key in ("cities", "stack"):
+            changed = {k: v for k, v in value.items() if old.get(key, {}).get(k) != v}
+            changed.update({k: None for k in old.get(key, {}) if k not in value})
+            if changed:
+                diff[key] = changed
+        elif old.get(key) != value:
+            diff[key] = value
+
+    return diff
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(game_id, draw_phase, keepalive):
+    """
+    Server-sent events for a game: the whole state to begin with, then what
+    changed after each write, with a comment every `keepalive` seconds to keep the
+    connection open. Run in the request's context.
+    """
+    broker = get_broker()
+    notices = broker.subscribe(channel(game_id))
+    sent = {}
+    try:
+        while True:
+            # end the last transaction, to see the latest commits
+            db.session.rollback()
+            game = Game.query.filter_by(id=game_id).one_or_none()
+            if game is None:
+                return
+
+            summary = state_summary(cached_game_state(game, draw_phase).state)
+            diff = state_diff(sent, summary)
+            if diff:
+                yield sse("state", diff)
+            sent = summary
+
+            while True:
+                try:
+                    notice = notices.get(timeout=keepalive)
+                    break
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+
+            # even if another worker wrote the turns, the game's version went up
+            # with them, so the state that's looked up next can't be an old one
+            draw_phase = notice["draw_phase"]
+    finally:
+        broker.unsubscribe(channel(game_id), notices)
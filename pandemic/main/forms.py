@@ -16,6 +16,7 @@ from wtforms import (
 from wtforms.validators import InputRequired, NumberRange, AnyOf
 
 from .. import constants as c
+from ..registry import hollow_men_id
 
 from ..main import widgets as wdg
 
@@ -158,19 +159,19 @@ class DrawForm(FlaskForm):
                 del self.relocation
 
             self.exile_cities.choices = [
-                (city.name, (city, 0))
-                for city in game_state["stack"][0]
-                if city != c.hollow_men
-                for _ in range(game_state["stack"][0][city])
+                (c.cities[i].name, (c.cities[i], 0))
+                for i in game_state["stack"].elements(0)
+                if i != hollow_men_id
             ]
 
         if game_state["epi_risk"] == 0.0 or self.turn_num == -1:
             del self.epidemic
             del self.second_epidemic
         else:
-            epi_stack = -6 if game_state["stack"][-6] else max(game_state["stack"])
+            stack = game_state["stack"]
             epidemic_cities = [("", "")] + [
-                (city.name, city.name) for city in game_state["stack"][epi_stack]
+                (c.cities[i].name, c.cities[i].name)
+                for i, _ in stack.items(stack.epidemic_stack)
             ]
             self.epidemic.choices = epidemic_cities
 
@@ -214,9 +215,8 @@ class SetupInfectForm(FlaskForm):
         self.game.data = game_state["game_id"]
         self.epidemics = -1
         self.cities.choices = [
-            (city.name, (city, 1))
-            for city in game_state["stack"][1]
-            for _ in range(game_state["stack"][1][city])
+            (c.cities[i].name, (c.cities[i], 1))
+            for i in game_state["stack"].elements(1)
         ]
 
     def validate_cities(self, field, setup=True):
@@ -248,11 +248,10 @@ class InfectForm(SetupInfectForm):
             del self.skip_infection
 
         choices = []
-        for i in range(1, max(game_state["stack"]) + 1):
+        for i in range(1, game_state["stack"].max_stack + 1):
             choices.extend(
-                (city.name, (city, i))
-                for city in game_state["stack"][i]
-                for _ in range(game_state["stack"][i][city])
+                (c.cities[j].name, (c.cities[j], i))
+                for j in game_state["stack"].elements(i)
             )
 
             n_cities = sum(1 for _, (city, _) in choices if city != c.hollow_men)
@@ -302,11 +301,10 @@ class RemoveCityForm(FlaskForm):
             self.cities.description = "Select cities (up to 2) for resilient pop"
 
         self.cities.choices = [
-            (city.name, (city, i))
+            (c.cities[j].name, (c.cities[j], i))
             for i in range(0, max_s + 1)
-            for city in game_state["stack"][i]
-            if city != c.hollow_men
-            for _ in range(game_state["stack"][i][city])
+            for j in game_state["stack"].elements(i)
+            if j != hollow_men_id
         ]
 
     def validate_cities(self, field):
@@ -341,12 +339,8 @@ class ForecastForm(FlaskForm):
         super(ForecastForm, self).__init__(*args, **kwargs)
 
         cities = []
-        for i in range(1, max(game_state["stack"]) + 1):
-            cities.extend(
-                city
-                for city in game_state["stack"][i]
-                for _ in range(game_state["stack"][i][city])
-            )
+        for i in range(1, game_state["stack"].max_stack + 1):
+            cities.extend(c.cities[j] for j in game_state["stack"].elements(i))
             if len(cities) >= 8:
                 break
 
@@ -0,0 +1,284 @@
+# exact risks over the next few turns. This follows the same model as risk.py (cards
+# are drawn uniformly from the top stack, hollow men don't count towards the infection
+# rate, and the bottom card of the epidemic stack is equally likely to be any of
+# them) but pushes a probability distribution over game states forward one card at a
+# time (or, for the infections, a stack at a time) instead of looking at a single
+# step.
+#
+# The other cities all behave the same as far as one city is concerned, so each city
+# gets its own run where every stack is just (its cards, other city cards, hollow
+# men). That keeps the states few enough to merge identical ones after every card,
+# and cities that start out with the same stacks share a run. States below a
+# probability threshold are dropped, as are the least likely past a cap on how many
+# are followed at once, with the dropped mass reported. Served at
+# /api/game/<id>/horizon
+
+import functools
+from collections import defaultdict, namedtuple
+from math import comb
+from operator import itemgetter
+
+from pandemic import constants as c
+from pandemic.registry import hollow_men_id
+
+CITY, OTHER, HOLLOW = range(3)
+
+# stacks are (city, other, hollow men) counts and `pile` holds the non-empty stacks
+# of the draw pile, from the top down. `block`, `left` and `pending` are the epidemic
+# block of the next player card, the cards left in it and if its epidemic is still
+# to come, and `to_infect` is the number of infection cards left to draw this turn
+State = namedtuple(
+    "State",
+    "box_six pile discard block left pending epidemics to_infect infected hollow_men",
+)
+
+
+def lumped_stacks(stack, city):
+    """The box six, draw pile and discard stacks of an InfectionStack, for `city`"""
+
+    def lump(i):
+        x = stack.count(i, city) if city is not None else 0
+        h = stack.count(i, hollow_men_id)
+        return x, stack.size(i) - x - h, h
+
+    pile = tuple(lump(i) for i in range(1, stack.max_stack + 1) if stack.size(i))
+    return lump(-6), pile, lump(0)
+
+
+def draw_card(stack):
+    """(kind, probability, stack without that card) for each kind of card in a stack"""
+    size = sum(stack)
+    for kind, n in enumerate(stack):
+        if n:
+            yield kind, n / size, stack[:kind] + (n - 1,) + stack[kind + 1 :]
+
+
+def add_card(stack, kind):
+    return stack[:kind] + (stack[kind] + 1,) + stack[kind + 1 :]
+
+
+def epidemic(state):
+    """Draw the bottom card of box six or the draw pile, then intensify"""
+    if any(state.box_six):
+        bottom = state.box_six
+    elif state.pile:
+        bottom = state.pile[-1]
+    else:
+        bottom = state.discard
+
+    for kind, p, rest in draw_card(bottom):
+        box_six, pile, discard = state.box_six, state.pile, state.discard
+        if any(box_six):
+            box_six = rest
+        elif pile:
+            pile = pile[:-1] + ((rest,) if any(rest) else ())
+        else:
+            discard = rest
+
+        yield p, state._replace(
+            box_six=box_six,
+            pile=(add_card(discard, kind),) + pile,
+            discard=(0, 0, 0),
+            epidemics=state.epidemics + 1,
+            infected=state.infected or kind == CITY,
+        )
+
+
+def player_card(state, blocks):
+    """Draw one player card, which might be an epidemic"""
+    if state.left == 0:
+        # out of player cards
+        yield 1.0, state
+        return
+
+    if state.left > 1:
+        after = dict(left=state.left - 1)
+    elif state.block + 1 < len(blocks):
+        after = dict(block=state.block + 1, left=blocks[state.block + 1], pending=True)
+    else:
+        after = dict(left=0, pending=False)
+
+    p_epi = 1.0 / state.left if state.pending else 0.0
+    if p_epi < 1.0:
+        yield 1.0 - p_epi, state._replace(**after)
+
+    if p_epi > 0.0:
+        after.setdefault("pending", False)
+        for p, next_state in epidemic(state._replace(**after)):
+            yield p_epi * p, next_state
+
+
+@functools.lru_cache(maxsize=4096)
+def infection_draws(stack, n):
+    """
+    (probability, (city, other, hollow men) drawn) for each way of drawing from the
+    top of a stack until `n` cards that aren't hollow men have come up, or it's empty
+    """
+    x, o, h = stack
+    if n > x + o:
+        return ((1.0, stack),)
+
+    # the cards are drawn in a random order, so which n of the city and other cards
+    # come up is hypergeometric, and (independently) the number of hollow men that
+    # come up before the last of them is negative hypergeometric
+    non_hollow = comb(x + o, n)
+    draws = []
+    for k in range(h + 1):
+        p_k = comb(k + n - 1, k) * comb(x + o - n + h - k, h - k) / comb(x + o + h, h)
+        for a in range(max(0, n - o), min(x, n) + 1):
+            draws.append(
+                (p_k * comb(x, a) * comb(o, n - a) / non_hollow, (a, n - a, k))
+            )
+    return tuple(draws)
+
+
+def infection_stack(state, count_hollow_men):
+    """Draw the infection cards that come from the top stack of the pile"""
+    box_six, pile, discard, block, left, pending, epidemics, to_infect = state[:8]
+    if not to_infect or not pile:
+        yield 1.0, state._replace(to_infect=0)
+        return
+
+    top = pile[0]
+    # this is the hot loop, so the states are built directly
+    for p, (a, b, k) in infection_draws(top, to_infect):
+        rest = (top[CITY] - a, top[OTHER] - b, top[HOLLOW] - k)
+        yield p, State(
+            box_six,
+            ((rest,) if any(rest) else ()) + pile[1:],
+            (discard[CITY] + a, discard[OTHER] + b, discard[HOLLOW] + k),
+            block,
+            left,
+            pending,
+            epidemics,
+            to_infect - a - b,
+            state.infected or a > 0,
+            state.hollow_men + (k if count_hollow_men else 0),
+        )
+
+
+class Distribution:
+    """
+    Steps a list of (state, probability) pairs through a transition, merging
+    identical states (or not, which is the naive enumeration of every path) and
+    dropping those below `threshold`, then the least likely beyond `max_states`
+    """
+
+    def __init__(self, merge=True, threshold=0.0, max_states=None):
+        self.merge = merge
+        self.threshold = threshold
+        self.max_states = max_states
+        self.dropped = 0.0
+        self.peak = 0
+
+    def step(self, dist, transition):
+        new_dist = defaultdict(float) if self.merge else []
+        for state, p in dist:
+            for q, next_state in transition(state):
+                pq = p * q
+                if pq < self.threshold:
+                    self.dropped += pq
+                elif self.merge:
+                    new_dist[next_state] += pq
+                else:
+                    new_dist.append((next_state, pq))
+
+        if self.merge:
+            new_dist = list(new_dist.items())
+        if self.max_states is not None and len(new_dist) > self.max_states:
+            new_dist.sort(key=itemgetter(1), reverse=True)
+            self.dropped += sum(p for _, p in new_dist[self.max_states :])
+            del new_dist[self.max_states :]
+        self.peak = max(self.peak, len(new_dist))
+        return new_dist
+
+
+def run(start, blocks, turns, count_hollow_men, steps):
+    """
+    The distribution over states after `turns` turns, leaving out the ones where the
+    city was infected, and the total probability of those
+    """
+    dist = [(start, 1.0)]
+    infected = 0.0
+
+    def draw(state):
+        return player_card(state, blocks)
+
+    def infect(state):
+        return infection_stack(state, count_hollow_men)
+
+    def absorb(dist):
+        # what happens after the city is infected doesn't matter
+        nonlocal infected
+        infected += sum(p for state, p in dist if state.infected)
+        return [(state, p) for state, p in dist if not state.infected]
+
+    def infection_rate(state):
+        return c.infection_rates[min(state.epidemics, len(c.infection_rates) - 1)]
+
+    for _ in range(turns):
+        for _ in range(c.draw):
+            dist = absorb(steps.step(dist, draw))
+
+        dist = [
+            (state._replace(to_infect=infection_rate(state)), p) for state, p in dist
+        ]
+        while any(state.to_infect for state, _ in dist):
+            dist = absorb(steps.step(dist, infect))
+
+    return dist, infected
+
+
+def horizon(game_state, turns=3, threshold=1e-9, merge=True, max_states=None):
+    """
+    The probability of each city being infected at least once over the next `turns`
+    turns (epidemics included) and the distribution of the number of hollow men
+    drawn. Also returns the probability mass dropped by pruning, summed over all
+    the runs, and the most states held at once, which `max_states` caps.
+    """
+    stack = game_state["stack"]
+    blocks = game_state["epidemic_blocks"]
+    steps = Distribution(merge, threshold, max_states)
+
+    def start(city):
+        box_six, pile, discard = lumped_stacks(stack, city)
+        return State(
+            box_six=box_six,
+            pile=pile,
+            discard=discard,
+            block=0,
+            left=blocks[0],
+            pending=game_state["epidemic_pending"],
+            epidemics=max(game_state["epidemics"], 0),
+            to_infect=0,
+            infected=False,
+            hollow_men=0,
+        )
+
+    runs = {}
+    p_infected = {}
+    for city in range(len(c.cities)):
+        if city == hollow_men_id:
+            continue
+
+        state = start(city)
+        if not any(kind[CITY] for kind in (state.box_six, state.discard, *state.pile)):
+            p_infected[city] = 0.0
+            continue
+
+        if state not in runs:
+            _, runs[state] = run(state, blocks, turns, False, steps)
+        p_infected[city] = runs[state]
+
+    hollow_men = defaultdict(float)
+    dist, _ = run(start(None), blocks, turns, True, steps)
+    for state, p in dist:
+        hollow_men[state.hollow_men] += p
+
+    return {
+        "turns": turns,
+        "p_infected": p_infected,
+        "hollow_men": [hollow_men[k] for k in range(max(hollow_men, default=0) + 1)],
+        "dropped": steps.dropped,
+        "states": steps.peak,
+    }
@@ -0,0 +1,446 @@
+# Prometheus metrics, served as text at /metrics: request latencies, statuses and
+# query counts by route, the time requests spend in each phase (replaying turns and
+# working out risks among them, see timing.py), how many turns each game state
+# replays, the caches' hits and misses, and how many games are being played.
+# Recording never takes a lock: each thread only ever adds to its own values, and a
+# scrape adds them up. With METRICS_DIR set, each worker process also writes its
+# totals to a file there now and then, and a scrape of any one worker adds up all of
+# the files
+
+import atexit
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+Metric = namedtuple("Metric", "name kind help buckets")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# what's recorded as it happens, by name
+METRICS = {
+    metric.name: metric
+    for metric in (
+        Metric(
+            "pandemic_requests_total",
+            "counter",
+            "Requests handled, by route and status",
+            None,
+        ),
+        Metric(
+            "pandemic_request_duration_seconds",
+            "histogram",
+            "Time taken to handle a request, by route",
+            LATENCY_BUCKETS,
+        ),
+        Metric(
+            "pandemic_request_queries",
+            "histogram",
+            "Database queries made by a request, by route",
+            COUNT_BUCKETS,
+        ),
+        Metric(
+            "pandemic_phase_duration_seconds",
+            "histogram",
+            "Time a request spent on database queries (db), replaying turns (replay),"
+            " risk calculations (risk), building forms (form) and rendering"
+            " (render), by route",
+            LATENCY_BUCKETS,
+        ),
+        Metric(
+            "pandemic_replay_turns",
+            "histogram",
+            "Turns replayed to work out a game state",
+            COUNT_BUCKETS,
+        ),
+    )
+}
+
+
+class Registry:
+    """
+    Counters and histograms, keyed by (name, labels) with the labels a tuple of
+    (name, value) pairs. A counter's value is a number, a histogram's a list of the
+    counts in each bucket (the last one +Inf) followed by the sum. The values are
+    held per thread, and only a thread itself writes to its own, so recording needs
+    no lock. Reading copies each thread's values, and folds in those of threads that
+    have finished for good.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self.threads = {}
+        self.retired = {}
+        # for reading and retiring only, recording never takes it
+        self.lock = threading.Lock()
+
+    def values(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            pass
+
+        values = self.local.values = {}
+        self.threads[threading.current_thread()] = values
+        # some servers start a thread per request, so tidy up after the finished
+        # ones as new ones turn up as well as when scraped (unless that's happening)
+        if self.lock.acquire(blocking=False):
+            try:
+                self.retire()
+            finally:
+                self.lock.release()
+        return values
+
+    def inc(self, name, labels=(), amount=1):
+        if not self.enabled:
+            return
+        values = self.values()
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled:
+            return
+        values = self.values()
+        key = (name, labels)
+        counts = values.get(key)
+        if counts is None:
+            counts = values[key] = [0] * (len(METRICS[name].buckets) + 2)
+        counts[bisect.bisect_left(METRICS[name].buckets, value)] += 1
+        counts[-1] += value
+
+    def retire(self):
+        for thread, values in list(self.threads.items()):
+            if not thread.is_alive():
+                del self.threads[thread]
+                merge(self.retired, values)
+
+    def collect(self):
+        """Everything recorded so far, added up over the threads"""
+        with self.lock:
+            self.retire()
+            total = merge({}, self.retired)
+            for values in list(self.threads.values()):
+                merge(total, values.copy())
+
+        return total
+
+
+def merge(total, values):
+    """Add `values` (from a Registry) into `total`"""
+    for key, value in values.items():
+        if isinstance(value, list):
+            counts = total.setdefault(key, [0] * len(value))
+            for i, n in enumerate(value):
+                counts[i] += n
+        else:
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+registry = Registry()
+
+# when each game last had a request, by game id
+active_games = {}
+
+
+def request_finished(sender, response, durations, queries):
+    """Record a request timed by timing.py"""
+    from flask import request, session
+
+    # a 404 has no endpoint
+    route = (("endpoint", request.endpoint or ""), ("method", request.method))
+    registry.inc(
+        "pandemic_requests_total", route + (("status", str(response.status_code)),)
+    )
+    registry.observe("pandemic_request_duration_seconds", durations["total"], route)
+    registry.observe("pandemic_request_queries", queries, route)
+    for name, seconds in durations.items():
+        if name != "total":
+            registry.observe(
+                "pandemic_phase_duration_seconds", seconds, route + (("phase", name),)
+            )
+
+    game_id = (request.view_args or {}).get("game_id") or session.get("game_id")
+    if game_id:
+        active_games[game_id] = time.time()
+
+
+def cache_stats():
+    """Hits, misses and entries of this process's caches, by name"""
+    from pandemic.main import tables
+    from pandemic.main.speculate import speculations
+    from pandemic.main.state import game_states
+
+    caches = {}
+    for name, stats in (
+        ("game_states", game_states.stats()),
+        ("speculations", speculations.stats()),
+    ):
+        caches[name] = dict(
+            hits=stats["hits"], misses=stats["misses"], entries=stats["size"]
+        )
+    for name, stats in tables.cache_stats().items():
+        # only the lookups out of the tables' range get this far
+        caches[f"{name}_cache"] = dict(
+            hits=stats["hits"], misses=stats["misses"], entries=stats["size"]
+        )
+
+    return caches
+
+
+def snapshot(window):
+    """
+    This process's metrics, in a form that can be written out as JSON and added up
+    with other processes'
+    """
+    # forget the games that have been idle for a while, putting back any that had a
+    # request in the meantime
+    cutoff = time.time() - window
+    for game_id, seen in list(active_games.items()):
+        if seen < cutoff:
+            seen = active_games.pop(game_id, seen)
+            if seen >= cutoff:
+                active_games.setdefault(game_id, seen)
+
+    return dict(
+        values=[
+            [name, [list(label) for label in labels], value]
+            for (name, labels), value in registry.collect().items()
+        ],
+        caches=cache_stats(),
+        games={str(game_id): seen for game_id, seen in list(active_games.items())},
+    )
+
+
+def combine(snapshots):
+    """
+    Add up the (snapshot, live) pairs of some processes. Entries in the caches
+    only count for the processes that are still running
+    """
+    values, caches, games = {}, {}, {}
+    for snap, live in snapshots:
+        merge(
+            values,
+            {
+                (name, tuple(map(tuple, labels))): value
+                for name, labels, value in snap["values"]
+            },
+        )
+        for name, stats in snap["caches"].items():
+            total = caches.setdefault(name, dict(hits=0, misses=0, entries=None))
+            total["hits"] += stats["hits"]
+            total["misses"] += stats["misses"]
+            if live and stats["entries"] is not None:
+                total["entries"] = (total["entries"] or 0) + stats["entries"]
+        for game_id, seen in snap["games"].items():
+            games[game_id] = max(seen, games.get(game_id, 0))
+
+    return values, caches, games
+
+
+# writing this process's file in the shared directory: when it was last written,
+# and which process did (a forked worker starts off with its parent's)
+flush_lock = threading.Lock()
+last_flush = 0.0
+flushed_by = None
+
+
+def process_file(directory):
+    return os.path.join(directory, f"{os.getpid()}.json")
+
+
+def flush(directory, window, blocking=True):
+    """Write this process's snapshot to its file, replacing the last one"""
+    global last_flush, flushed_by
+    if not flush_lock.acquire(blocking=blocking):
+        # another thread's doing it
+        return
+
+    try:
+        path = process_file(directory)
+        if flushed_by != os.getpid() and os.path.exists(path):
+            # left by an earlier process with the same pid, keep its counts
+            os.replace(path, path[: -len(".json")] + f"-{time.time_ns()}.json")
+
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot(window), f)
+        os.replace(path + ".tmp", path)
+        last_flush, flushed_by = time.monotonic(), os.getpid()
+    finally:
+        flush_lock.release()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory):
+    """(snapshot, live) for each process that has written to the directory"""
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        name = os.path.basename(path)[: -len(".json")]
+        try:
+            with open(path) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            # gone, or not one of ours
+            continue
+        # the files of processes that have finished (or been replaced) are named
+        # <pid>-<time>
+        snapshots.append((snap, name.isdigit() and alive(int(name))))
+
+    return snapshots
+
+
+def number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(value)
+
+
+def sample(name, labels, value):
+    if labels:
+        name += (
+            "{"
+            + ",".join(
+                '{}="{}"'.format(
+                    label,
+                    str(v)
+                    .replace("\\", "\\\\")
+                    .replace('"', '\\"')
+                    .replace("\n", "\\n"),
+                )
+                for label, v in labels
+            )
+            + "}"
+        )
+    return f"{name} {number(value)}"
+
+
+def exposition(values, caches, games, window):
+    """Metrics in the Prometheus text format"""
+    lines = []
+
+    def header(name, kind, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for metric in METRICS.values():
+        header(metric.name, metric.kind, metric.help)
+        for (name, labels), value in sorted(values.items()):
+            if name != metric.name:
+                continue
+            if metric.kind == "counter":
+                lines.append(sample(name, labels, value))
+                continue
+
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (math.inf,), value):
+                cumulative += count
+                lines.append(
+                    sample(
+                        f"{name}_bucket", labels + (("le", number(bound)),), cumulative
+                    )
+                )
+            lines.append(sample(f"{name}_sum", labels, value[-1]))
+            lines.append(sample(f"{name}_count", labels, cumulative))
+
+    for kind, stat, help in (
+        ("counter", "hits", "Lookups found in a cache (or table)"),
+        ("counter", "misses", "Lookups not found in a cache (or table)"),
+    ):
+        header(f"pandemic_cache_{stat}_total", kind, help)
+        for name, stats in sorted(caches.items()):
+            lines.append(
+                sample(f"pandemic_cache_{stat}_total", (("cache", name),), stats[stat])
+            )
+
+    header("pandemic_cache_hit_ratio", "gauge", "Hits over lookups, for each cache")
+    for name, stats in sorted(caches.items()):
+        lookups = stats["hits"] + stats["misses"]
+        if lookups:
+            lines.append(
+                sample(
+                    "pandemic_cache_hit_ratio",
+                    (("cache", name),),
+                    stats["hits"] / lookups,
+                )
+            )
+
+    header("pandemic_cache_entries", "gauge", "Entries held, for each cache")
+    for name, stats in sorted(caches.items()):
+        if stats["entries"] is not None:
+            lines.append(
+                sample("pandemic_cache_entries", (("cache", name),), stats["entries"])
+            )
+
+    header(
+        "pandemic_active_games",
+        "gauge",
+        f"Games with a request in the last {window} seconds",
+    )
+    cutoff = time.time() - window
+    lines.append(
+        sample(
+            "pandemic_active_games",
+            (),
+            sum(seen >= cutoff for seen in games.values()),
+        )
+    )
+
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Record metrics and serve them at /metrics, if the config asks for them"""
+    if not app.config["METRICS"]:
+        return
+
+    from flask import Response
+
+    from pandemic.main.timing import request_timed
+
+    directory = app.config["METRICS_DIR"]
+    interval = app.config["METRICS_FLUSH"]
+    window = app.config["METRICS_ACTIVE_WINDOW"]
+    registry.enabled = True
+
+    def record(sender, **timed):
+        request_finished(sender, **timed)
+        if directory and time.monotonic() - last_flush >= interval:
+            flush(directory, window, blocking=False)
+
+    request_timed.connect(record, app, weak=False)
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        # so the last few requests of a worker that's shutting down still count
+        atexit.register(flush, directory, window)
+
+    def metrics():
+        if directory:
+            flush(directory, window)
+            snapshots = read_snapshots(directory)
+        else:
+            snapshots = [(snapshot(window), True)]
+
+        return Response(
+            exposition(*combine(snapshots), window),
+            mimetype="text/plain; version=0.0.4",
+        )
+
+    app.add_url_rule("/metrics", "metrics", metrics)
@@ -0,0 +1,227 @@
+# Monte Carlo outlook over the next few turns: plays out random futures from the
+# current stack and epidemic blocks and counts which cities get infected along the
+# way. Samples are drawn in batches with numpy, with the batches spread over the
+# shared process pool (see pool.py) until the estimates settle, or the sample count
+# or the time budget runs out
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+
+from pandemic import constants as c
+from pandemic.main import pool
+from pandemic.main.stack import InfectionStack
+from pandemic.registry import hollow_men_id
+
+infection_rates = np.array(c.infection_rates)
+
+
+def epidemic_turns(rng, n, blocks, pending, turns):
+    """
+    The number of epidemics in each of the next `turns` draws, for `n` samples.
+    `blocks` are the cards left in each epidemic block, starting with the current
+    one, which only has an epidemic left in it if `pending`.
+    """
+    blocks = np.array(blocks)
+    starts = np.cumsum(blocks) - blocks
+    position = starts + (rng.random((n, len(blocks))) * blocks).astype(int)
+    if not pending:
+        position = position[:, 1:]
+
+    turn = position // c.draw
+    return np.stack([(turn == t).sum(axis=1) for t in range(turns)], axis=1)
+
+
+def pick(rng, weights):
+    """One column for each row of `weights`, with probability proportional to them"""
+    totals = weights.cumsum(axis=1)
+    u = rng.random(len(weights)) * totals[:, -1]
+    return (totals <= u[:, None]).sum(axis=1)
+
+
+def simulate(counts, epidemics, blocks, pending, turns, n, seed):
+    """
+    Plays `n` random futures of `turns` turns each from a stack matrix (the
+    `counts` of an InfectionStack). Returns the sample count, how many samples
+    infected each city at least once (epidemics included), and a histogram of the
+    hollow men drawn per sample.
+    """
+    rng = np.random.default_rng(seed)
+    o = InfectionStack.offset
+
+    # every epidemic pushes the draw pile down a stack
+    rows, n_cities = counts.shape
+    stack = np.zeros((n, rows + 2 * turns, n_cities), dtype=int)
+    stack[:, :rows] = counts
+    sizes = stack.sum(axis=2)
+
+    samples = np.arange(n)
+    epidemics = np.full(n, max(epidemics, 0))
+    infected = np.zeros((n, n_cities), dtype=bool)
+    hollow_men = np.zeros(n, dtype=int)
+
+    epidemic_counts = epidemic_turns(rng, n, blocks, pending, turns)
+    depth = np.arange(sizes.shape[1])
+
+    for t in range(turns):
+        for k in range(epidemic_counts[:, t].max(initial=0)):
+            s = samples[epidemic_counts[:, t] > k]
+
+            # the bottom card of box six, or of the draw pile
+            bottom = np.where(sizes[s] > 0, depth, -1).max(axis=1)
+            epi_stack = np.where(sizes[s, 0] > 0, 0, bottom)
+            drawable = sizes[s, epi_stack] > 0
+            s, epi_stack = s[drawable], epi_stack[drawable]
+            city = pick(rng, stack[s, epi_stack])
+
+            stack[s, epi_stack, city] -= 1
+            sizes[s, epi_stack] -= 1
+            stack[s, o, city] += 1
+            sizes[s, o] += 1
+            infected[s, city] = True
+            epidemics[s] += 1
+
+            # intensify: the discard pile goes back on top
+            stack[s, o + 1 :] = stack[s, o:-1]
+            stack[s, o] = 0
+            sizes[s, o + 1 :] = sizes[s, o:-1]
+            sizes[s, o] = 0
+
+        remaining = infection_rates[np.minimum(epidemics, len(infection_rates) - 1)]
+        while True:
+            # draw one card from the top of the pile, for every sample still drawing
+            in_pile = sizes[:, o + 1 :] > 0
+            s = samples[(remaining > 0) & in_pile.any(axis=1)]
+            if not len(s):
+                break
+
+            top = o + 1 + in_pile[s].argmax(axis=1)
+            city = pick(rng, stack[s, top])
+
+            stack[s, top, city] -= 1
+            sizes[s, top] -= 1
+            stack[s, o, city] += 1
+            sizes[s, o] += 1
+
+            hollow = city == hollow_men_id
+            hollow_men[s[hollow]] += 1
+            infected[s[~hollow], city[~hollow]] = True
+            remaining[s[~hollow]] -= 1
+
+    return n, infected.sum(axis=0), np.bincount(hollow_men)
+
+
+def outlook(
+    game_state,
+    turns=3,
+    samples=None,
+    time_budget=None,
+    tolerance=None,
+    batch_size=500,
+    seed=0,
+    workers=None,
+):
+    """
+    Samples futures for the next `turns` turns, until there are `samples` of them,
+    `time_budget` seconds have passed or the standard error of every probability is
+    within `tolerance` (whichever comes first, at least one batch).
+    Batch i is seeded with (seed, i), so a fixed sample count gives the same result
+    however the batches are spread out. `workers` batches run at once in the shared
+    pool (None for one per worker process), or with `workers=0` in this process.
+
+    Returns the number of samples, each city's probability of being infected at least
+    once, and the distribution of the number of hollow men drawn.
+    """
+    if samples is None and time_budget is None and tolerance is None:
+        raise ValueError("need a sample count, a time budget or a tolerance")
+
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    args = (
+        game_state["stack"].counts,
+        game_state["epidemics"],
+        game_state["epidemic_blocks"],
+        game_state["epidemic_pending"],
+        turns,
+    )
+
+    def batches():
+        i = 0
+        while samples is None or i * batch_size < samples:
+            n = (
+                batch_size
+                if samples is None
+                else min(batch_size, samples - i * batch_size)
+            )
+            yield n, (seed, i)
+            i += 1
+
+    def converged():
+        if tolerance is None or not n_samples:
+            return False
+        p = np.concatenate((n_infected, hollow_men)) / n_samples
+        return np.sqrt(p * (1 - p) / n_samples).max() <= tolerance
+
+    def keep_going():
+        if converged():
+            return False
+        return deadline is None or time.monotonic() < deadline
+
+    n_samples = 0
+    n_infected = np.zeros(len(c.cities), dtype=int)
+    hollow_men = np.zeros(c.hollow_men.infection_cards + 1, dtype=int)
+
+    def collect(result):
+        nonlocal n_samples, n_infected, hollow_men
+        n, infected, hollow = result
+        n_samples += n
+        n_infected += infected
+        if len(hollow) > len(hollow_men):
+            hollow_men = np.pad(hollow_men, (0, len(hollow) - len(hollow_men)))
+        hollow_men[: len(hollow)] += hollow
+
+    todo = batches()
+    if workers == 0:
+        for n, batch_seed in todo:
+            collect(simulate(*args, n, batch_seed))
+            if not keep_going():
+                break
+    else:
+        workers = workers or pool.workers or os.cpu_count()
+        executor = pool.get_executor()
+        running = set()
+        for n, batch_seed in todo:
+            running.add(executor.submit(simulate, *args, n, batch_seed))
+            if len(running) >= workers:
+                break
+
+        while running:
+            # always wait for at least one batch
+            if deadline is None or not n_samples:
+                timeout = None
+            else:
+                timeout = max(deadline - time.monotonic(), 0)
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future.result())
+                if keep_going():
+                    batch = next(todo, None)
+                    if batch is not None:
+                        running.add(executor.submit(simulate, *args, *batch))
+
+            if not keep_going():
+                for future in running:
+                    future.cancel()
+                break
+
+    return {
+        "turns": turns,
+        "samples": n_samples,
+        "p_infected": {
+            city: n / n_samples
+            for city, n in enumerate(n_infected.tolist())
+            if city != hollow_men_id
+        },
+        "hollow_men": (hollow_men / n_samples).tolist(),
+    }
@@ -0,0 +1,35 @@
+# the process pool shared by the work that's spread over processes: speculating on
+# the infection step and sampling the outlook. The server is threaded and holds
+# database connections, so the workers aren't forked from it (a fork can inherit a
+# lock some other thread holds, and the connections). They come from a fork server
+# instead, which has the engine and the outlook imported already
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# how many worker processes to start (None for one per cpu), set by init_app
+workers = None
+
+# created on first use and kept for the life of the process
+executor = None
+
+
+def get_context():
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["pandemic.main.engine", "pandemic.main.outlook"])
+    return context
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context())
+    return executor
+
+
+def init_app(app):
+    global workers
+    workers = app.config["WORKER_PROCESSES"]
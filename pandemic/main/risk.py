@@ -1,25 +1,8 @@
-import functools
-import math
-import operator as op
 from collections import defaultdict
 
 from pandemic import constants as c
-
-
-def ncr(n, r):
-    r = min(r, n - r)
-    if r < 0:
-        return 0.0
-
-    numer = functools.reduce(op.mul, range(n, n - r, -1), 1)
-    denom = math.factorial(r)
-
-    return numer / denom
-
-
-def hg_pmf(k, M, n, N):
-    N = min(N, M)  # allows for infection rate > stack size
-    return ncr(n, k) * ncr(M - n, N - k) / ncr(M, N)
+from pandemic.main.tables import hg_pmf, ncr
+from pandemic.registry import hollow_men_id
 
 
 def nb_pmf(k, r, n, m):
@@ -44,19 +27,17 @@ def inf_risks(stack, infection_rate, cond_p):
     inf_risk = defaultdict(list)
     hollow_risk = []
 
-    for i in range(1, max(stack) + 1):
+    for i in range(1, stack.max_stack + 1):
         if infection_rate > 0:
-            stack_n = sum(stack[i].values()) - stack[i][c.hollow_men]
-            for city in stack[i]:
-                if city != c.hollow_men:
+            stack_n = stack.size(i) - stack.count(i, hollow_men_id)
+            for city, n in stack.items(i):
+                if city != hollow_men_id:
                     inf_risk[city].extend(
-                        cond_p * hg_pmf(j, stack_n, stack[i][city], infection_rate)
-                        for j in range(1, stack[i][city] + 1)
+                        cond_p * hg_pmf(j, stack_n, n, infection_rate)
+                        for j in range(1, n + 1)
                     )
                 else:
-                    hollow_risk.extend(
-                        hm_risk(cond_p, infection_rate, stack_n, stack[i][city])
-                    )
+                    hollow_risk.extend(hm_risk(cond_p, infection_rate, stack_n, n))
 
             infection_rate -= stack_n
         else:
@@ -66,7 +47,7 @@ def inf_risks(stack, infection_rate, cond_p):
 
 
 def trim_risk_dicts(inf_risk, hollow_risk, max_len):
-    for city in c.cities:
+    for city in range(len(c.cities)):
         inf_risk[city].extend(0.0 for _ in range(len(inf_risk[city]), max_len))
 
     return (
@@ -79,8 +60,8 @@ def infection_risk(stack, infection_rate, p_no_epi):
     inf_risk, hollow_risk = inf_risks(stack, infection_rate, p_no_epi)
 
     for i in (-1, 0):
-        for city in stack[i]:
-            inf_risk[city].extend(0.0 for _ in range(stack[i][city]))
+        for city, n in stack.items(i):
+            inf_risk[city].extend(0.0 for _ in range(n))
 
     return trim_risk_dicts(inf_risk, hollow_risk, min(infection_rate, c.max_inf))
 
@@ -93,23 +74,23 @@ def epi_infection_risk(stack, infection_rate, p_epi, p_city_epi):
     inf_risk = defaultdict(list)
     hollow_risk = []
 
-    epi_stack = -6 if stack[-6] else max(stack)
-    stack_n = sum(stack[0].values()) + 1
+    epi_stack = stack.epidemic_stack
+    stack_n = stack.size(0) + 1
 
-    for city in set(stack[epi_stack]).difference(stack[0]):
-        inf_risk[city].append(
-            p_epi * p_city_epi[city] * hg_pmf(1, stack_n, 1, infection_rate)
-        )
+    for city, _ in stack.items(epi_stack):
+        if not stack.count(0, city):
+            inf_risk[city].append(
+                p_epi * p_city_epi[city] * hg_pmf(1, stack_n, 1, infection_rate)
+            )
 
-    for city in stack[0]:
-        if city != c.hollow_men:
+    for city, n in stack.items(0):
+        if city != hollow_men_id:
             inf_risk[city].extend(
-                p_epi
-                * p_inf0(p_city_epi[city], j, stack_n, stack[0][city], infection_rate)
-                for j in range(1, stack[0][city] + 1)
+                p_epi * p_inf0(p_city_epi[city], j, stack_n, n, infection_rate)
+                for j in range(1, n + 1)
             )
         else:
-            hollow_risk.extend(hm_risk(p_epi, infection_rate, stack_n, stack[0][city]))
+            hollow_risk.extend(hm_risk(p_epi, infection_rate, stack_n, n))
 
     extra_risk, extra_hollow_risk = inf_risks(stack, infection_rate - stack_n, p_epi)
 
@@ -0,0 +1,92 @@
+# speculative game states for the infection step. While the players are on the draw
+# page, the state after each epidemic they could record (or none) is worked out in
+# the background, so that submitting the draw form leaves the next page a cache
+# lookup. The replay engine doesn't need the database, so the work is spread over
+# the shared process pool (see pool.py)
+
+from flask import current_app
+
+from pandemic.main import pool
+from pandemic.main.cache import SpeculativeStates
+from pandemic.main.engine import play_turn
+from pandemic.main.state import adopt_game_state, game_states
+from pandemic.registry import city_id
+
+speculations = SpeculativeStates()
+
+
+def epidemic_outcomes(game_state):
+    """
+    The epidemics the draw form allows as tuples of city ids, most likely first:
+    none, each city in the epidemic stack and, if two are possible, each pair (the
+    same city twice only if it has two cards there)
+    """
+    if game_state["turn_num"] == -1 or game_state["epi_risk"] == 0.0:
+        return [()]
+
+    stack = game_state["stack"]
+    cities = sorted(stack.items(stack.epidemic_stack), key=lambda item: -item[1])
+    outcomes = [()] + [(city,) for city, _ in cities]
+
+    if game_state["epi_risk"] > 1.0:
+        # the second card comes from what's left of the stack after the first
+        pairs = [
+            (a, b, m * (n - 1) if a == b else m * n)
+            for a, m in cities
+            for b, n in cities
+            if a != b or m > 1
+        ]
+        outcomes += [(a, b) for a, b, _ in sorted(pairs, key=lambda pair: -pair[2])]
+
+    return outcomes
+
+
+def speculate_epidemics(game):
+    """
+    Start on the infection step's state for each of the epidemic outcomes, as long
+    as nothing else has been recorded for the turn yet. Call after
+    `get_game_state(game)` on the draw page.
+    """
+    budget = current_app.config["SPECULATE_BUDGET"]
+    if not budget:
+        return
+
+    base = game_states.key(game, True)
+    cached = game_states.peek(base)
+    if cached is None or cached.turn is None:
+        return
+
+    turn = cached.turn
+    if turn.monitor or turn.epidemic or turn.exiled or turn.forecasts:
+        return
+
+    executor = pool.get_executor()
+    earlier = cached.warnings
+
+    def submit(epidemic):
+        return executor.submit(
+            play_turn,
+            cached.before,
+            turn._replace(epidemic=list(epidemic)),
+            game.id,
+            game.funding_rate,
+            earlier,
+        )
+
+    speculations.start(base, epidemic_outcomes(cached.state), submit, budget)
+
+
+def take_speculation(game, base, turn):
+    """
+    After the draw form is committed, hand the state for what was recorded to the
+    next page if it was speculated on. `base` is the key of the draw page's state.
+    """
+    if turn.monitor or turn.exiled:
+        # not one of the outcomes, but the rest still need cancelling
+        outcome = None
+    else:
+        outcome = tuple(city_id(city) for city in turn.epidemic)
+
+    future = speculations.take(base, outcome)
+    if future is not None:
+        adopt_game_state(game_states.key(game, False), future)
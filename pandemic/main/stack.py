@@ -0,0 +1,192 @@
+import numpy as np
+
+from pandemic import constants as c
+from pandemic.registry import city_ids
+
+
+class InfectionStack:
+    """
+    The infection deck as a dense matrix of stack depth x city id, along with a
+    cached count of the cards in each stack.
+
+    Stack indices follow the game: -6 is box six, -1 is exiled, 0 is the discard pile
+    and 1, 2, ... are the stacks of the draw pile, from the top down. Rows are offset
+    so that box six is row 0.
+    """
+
+    offset = 6
+
+    def __init__(self, depth=16):
+        self.counts = np.zeros((self.offset + depth + 1, len(c.cities)), dtype=int)
+        self.sizes = np.zeros(self.offset + depth + 1, dtype=int)
+
+    @classmethod
+    def from_dict(cls, data):
+        stack = cls()
+        for i, cities in data.items():
+            for name, n in cities.items():
+                stack.add(int(i), city_ids[name], n)
+
+        return stack
+
+    def to_dict(self):
+        return {
+            i: {c.cities[city].name: n for city, n in self.items(i)}
+            for i in self.stacks()
+        }
+
+    def copy(self):
+        stack = InfectionStack.__new__(InfectionStack)
+        stack.counts = self.counts.copy()
+        stack.sizes = self.sizes.copy()
+        return stack
+
+    @staticmethod
+    def vector(cities):
+        """Converts a city id -> count mapping into a row vector"""
+        v = np.zeros(len(c.cities), dtype=int)
+        for city, n in cities.items():
+            v[city] += n
+        return v
+
+    def _grow(self, depth):
+        extra = self.offset + depth + 1 - len(self.sizes)
+        if extra > 0:
+            extra = max(extra, len(self.sizes))
+            self.counts = np.vstack(
+                (self.counts, np.zeros((extra, len(c.cities)), dtype=int))
+            )
+            self.sizes = np.concatenate((self.sizes, np.zeros(extra, dtype=int)))
+
+    def size(self, i):
+        i += self.offset
+        return int(self.sizes[i]) if 0 <= i < len(self.sizes) else 0
+
+    def count(self, i, city):
+        i += self.offset
+        return int(self.counts[i, city]) if 0 <= i < len(self.sizes) else 0
+
+    def row(self, i):
+        return self.counts[i + self.offset]
+
+    def stacks(self):
+        """Indices of all the non-empty stacks, in order"""
+        return [int(i) - self.offset for i in self.sizes.nonzero()[0]]
+
+    def items(self, i):
+        """(city id, count) for each city in stack i"""
+        if not self.size(i):
+            return []
+        row = self.row(i)
+        return [(int(j), int(row[j])) for j in row.nonzero()[0]]
+
+    def elements(self, i):
+        """Each card in stack i, repeated as many times as it appears"""
+        return [city for city, n in self.items(i) for _ in range(n)]
+
+    @property
+    def max_stack(self):
+        (nz,) = self.sizes.nonzero()
+        return int(nz[-1]) - self.offset if len(nz) else 0
+
+    @property
+    def epidemic_stack(self):
+        return -6 if self.size(-6) else self.max_stack
+
+    def add(self, i, city, n=1):
+        self._grow(i)
+        self.counts[i + self.offset, city] += n
+        self.sizes[i + self.offset] += n
+
+    def move(self, city, src, dst, n=1):
+        self.add(src, city, -n)
+        self.add(dst, city, n)
+
+    def shift_up(self):
+        """Push the discard pile and the draw pile down by one stack"""
+        self._grow(self.max_stack + 1)
+        o = self.offset
+        self.counts[o + 1 :] = self.counts[o:-1]
+        self.counts[o] = 0
+        self.sizes[o + 1 :] = self.sizes[o:-1]
+        self.sizes[o] = 0
+
+    def shift_down(self):
+        """Merge the top stack into the discard pile and move the others up"""
+        o = self.offset
+        self.counts[o] += self.counts[o + 1]
+        self.counts[o + 1 : -1] = self.counts[o + 2 :]
+        self.counts[-1] = 0
+        self.sizes[o] += self.sizes[o + 1]
+        self.sizes[o + 1 : -1] = self.sizes[o + 2 :]
+        self.sizes[-1] = 0
+
+    def settle(self):
+        """Make sure the top of the draw pile isn't empty, if there's anything left"""
+        while self.size(1) == 0 and self.max_stack > 1:
+            self.shift_down()
+
+    def epidemic(self, city):
+        """Draw `city` from the bottom, discard it and intensify. False if impossible"""
+        epi_stack = self.epidemic_stack
+        possible = self.count(epi_stack, city) > 0
+        if possible:
+            self.move(city, epi_stack, 0)
+
+        self.shift_up()
+        return possible
+
+    def exile(self, city, n, max_stack, to_stack):
+        """
+        Remove `n` cards of `city` from the discard pile (or the stacks above
+        `max_stack`) and put them in `to_stack`. False if they couldn't be found.
+        """
+        found = 0
+        for j in range(0, max_stack + 1):
+            k = min(n - found, self.count(j, city))
+            self.add(j, city, -k)
+            found += k
+            if found >= n:
+                break
+
+        self.add(to_stack, city, n)
+        return found >= n
+
+    def forecast(self, forecasts):
+        """Rearrange the top cards according to (city, stack_order) pairs"""
+        o = self.offset
+        for city, _ in forecasts:
+            j = int(np.flatnonzero(self.counts[o + 1 :, city])[0]) + 1
+            self.add(j, city, -1)
+
+        # every stack moves below the forecast stacks
+        self._grow(self.max_stack + 8)
+        self.counts[o + 9 :] = self.counts[o + 1 : -8]
+        self.counts[o + 1 : o + 9] = 0
+        self.sizes[o + 9 :] = self.sizes[o + 1 : -8]
+        self.sizes[o + 1 : o + 9] = 0
+
+        for city, stack_order in forecasts:
+            self.add(stack_order, city)
+
+    def infect(self, infected):
+        """
+        Move a vector of infected cards from the top of the draw pile to the discard
+        pile. False if they weren't all on top.
+        """
+        infected = infected.copy()
+        o = self.offset
+        while infected.any():
+            self.settle()
+            drawn = np.minimum(infected, self.counts[o + 1])
+            if not drawn.any():
+                return False
+
+            infected -= drawn
+            self.counts[o + 1] -= drawn
+            self.counts[o] += drawn
+            n = int(drawn.sum())
+            self.sizes[o + 1] -= n
+            self.sizes[o] += n
+
+        return True
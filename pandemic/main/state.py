@@ -1,267 +1,270 @@
-from collections import Counter, defaultdict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 
+import sqlalchemy as sa
 from flask import current_app, flash
-
-from pandemic import constants as c
-from pandemic.main.risk import epi_infection_risk, infection_risk
-from pandemic.models import Turn
-
-
-def log_stack(stack):
-    for i in sorted(stack):
-        stack_str = "\n\t".join(f"{city.name} ({stack[i][city]})" for city in stack[i])
-        current_app.logger.debug(f"\nstack {i}:\n\t{stack_str}\n\n")
-
-
-def clean_stack(stack):
-    return defaultdict(
-        Counter,
-        {i: ct for i, ct in ((i, Counter(stack[i].elements())) for i in stack) if ct},
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, selectinload
+
+from pandemic import db
+from pandemic.main.cache import GameStateCache
+from pandemic.main.engine import Replay, ReplayResult, TurnRecord, game_state
+from pandemic.main.metrics import registry
+from pandemic.main.stack import InfectionStack
+from pandemic.main.timing import phase
+from pandemic.main.trace import traced, tracing
+from pandemic.models import (
+    CityExile,
+    CityForecast,
+    CityInfection,
+    Game,
+    StackSnapshot,
+    Turn,
+    epidemics,
+)
+from pandemic.registry import city_id
+
+# game states computed by this process, the views invalidate them after each write
+game_states = GameStateCache()
+
+# game states being computed in the background, by cache key. The executor is
+# created on first use and kept for the life of the process
+precomputing = {}
+executor = None
+
+
+def get_executor(workers):
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    return executor
+
+
+def latest_snapshot(game):
+    # the newest snapshot for a completed turn, if any survived invalidation
+    return (
+        StackSnapshot.query.join(Turn, StackSnapshot.turn_id == Turn.id)
+        .options(contains_eager(StackSnapshot.turn))
+        .filter(Turn.game_id == game.id, Turn.turn_num < game.turn_num)
+        .order_by(Turn.turn_num.desc())
+        .first()
     )
 
 
-def increment_stack(stack):
-    return defaultdict(
-        Counter, {(i + (i >= 0) * 1): Counter(stack[i].elements()) for i in stack}
+def turn_history(game, after=None):
+    """
+    The turns of a game up to the current one (and after turn `after`), with
+    everything the replay touches loaded up front in a fixed number of queries
+    """
+    turns = Turn.query.filter(
+        Turn.game_id == game.id, Turn.turn_num <= game.turn_num
+    ).options(
+        selectinload(Turn.epidemic),
+        selectinload(Turn.exiled).joinedload(CityExile.city),
+        selectinload(Turn.forecasts).joinedload(CityForecast.city),
+        selectinload(Turn.infections).joinedload(CityInfection.city),
     )
+    if after is not None:
+        turns = turns.filter(Turn.turn_num > after)
 
+    return turns.order_by(Turn.turn_num).all()
 
-def decrement_stack(stack):
-    new_stack = defaultdict(Counter)
-    for i in stack:
-        new_stack[i - (i > 0) * 1] += stack[i]
-
-    return new_stack
 
+def bump_version(game):
+    """
+    Move a game on to a new version, on any write to its turns, so it's committed
+    along with them. Done in SQL, so concurrent writes each get their own.
+    """
+    game.version = Game.version + 1
 
-def epidemic(stack, epidemic_city):
-    epi_stack = -6 if stack[-6] else max(stack)
-
-    if stack[epi_stack][epidemic_city] < 1:
-        flash("WARNING: this epidemic shouldn't be possible, check records!")
-    else:
-        stack[epi_stack][epidemic_city] -= 1
-        stack[0][epidemic_city] += 1
 
-    return clean_stack(stack)
+def invalidate_snapshots(game_id, turn_num):
+    """Drop the snapshots for a game from `turn_num` onwards, call on any edit"""
+    edited_turns = db.session.query(Turn.id).filter(
+        Turn.game_id == game_id, Turn.turn_num >= turn_num
+    )
+    StackSnapshot.query.filter(StackSnapshot.turn_id.in_(edited_turns)).delete(
+        synchronize_session=False
+    )
 
 
-def get_game_state(game, draw_phase=True):
-    turns = (
-        Turn.query.filter_by(game_id=game.id)
-        .filter(Turn.turn_num <= game.turn_num)
-        .order_by(Turn.turn_num)
-        .all()
+def rewind(game, turn_num):
+    """
+    Delete a game's turns from `turn_num` onwards, along with everything recorded
+    for them and their snapshots, with one statement per table, and bump its
+    version. Commit afterwards and then invalidate the game's cached states.
+    """
+    doomed = sa.select(Turn.id).where(
+        Turn.game_id == game.id, Turn.turn_num >= turn_num
     )
-
-    city_cards = sum(city.player_cards for city in c.cities) - sum(
-        c.player_cards_in_box_six.values()
+    for table in (
+        CityExile.__table__,
+        CityForecast.__table__,
+        CityInfection.__table__,
+        StackSnapshot.__table__,
+        epidemics,
+    ):
+        db.session.execute(table.delete().where(table.c.turn_id.in_(doomed)))
+
+    db.session.execute(
+        Turn.__table__.delete().where(
+            Turn.game_id == game.id, Turn.turn_num >= turn_num
+        )
     )
-    epidemic_cards = c.epidemics[
-        min((k for k in c.epidemics if k >= city_cards), default=-1)
-    ]
-
-    # deck size after dealing the initial hands
-    post_setup_deck_size = (
-        city_cards
-        + epidemic_cards
-        + game.funding_rate
-        + c.extra_cards
-        - c.num_players * c.initial_hand_size[c.num_players]
+    game.turn_num = turn_num
+    bump_version(game)
+
+
+def turn_record(turn):
+    """The engine's plain version of a Turn"""
+    return TurnRecord(
+        turn_num=turn.turn_num,
+        monitor=turn.monitor,
+        skipped_epi=turn.skipped_epi,
+        epidemic=[city_id(city) for city in turn.epidemic],
+        exiled=[(city_id(ce.city), ce.count, ce.to_stack) for ce in turn.exiled],
+        forecasts=[(city_id(cf.city), cf.stack_order) for cf in turn.forecasts],
+        infections={city_id(ci.city): ci.count for ci in turn.infections},
     )
 
-    # number of post-setup cards drawn so far
-    if game.turn_num == -1:
-        ps_cards_drawn = 0
-        epidemics = -1
-        skipped_epi = 0
-    else:
-        ps_cards_drawn = (len(turns) - 1 - draw_phase) * c.draw
-        epidemics = 0
-        skipped_epi = 0
-
-    stack = defaultdict(Counter)
-    for city in c.cities:
-        if city == c.hollow_men:
-            stack[0][city] = city.infection_cards
-        else:
-            stack[1][city] = city.infection_cards - c.infection_cards_in_box_six[city]
-            stack[-6][city] = c.infection_cards_in_box_six[city]
-
-    current_app.logger.info(f"City cards in starting deck: {city_cards}")
-    current_app.logger.info(f"Epidemics: {epidemic_cards}\n")
-
-    current_app.logger.debug(f"----- TURN {len(turns) - 1} ---------\n\n")
-
-    for i, turn in enumerate(turns):
-        stack = clean_stack(stack)
-        current_app.logger.debug(f"\non turn {turn.turn_num}:")
-        # log_stack(stack)
-
-        if turn.monitor:
-            current_app.logger.debug(
-                f"monitored for {turn.monitor} actions,"
-                f" skipped {turn.skipped_epi} epidemics"
-            )
-
-            skipped_epi += turn.skipped_epi
-            ps_cards_drawn += turn.monitor * c.monitor
-
-        if turn.epidemic:
-            current_app.logger.debug(f"epidemic: {', '.join(map(str, turn.epidemic))}")
-            epidemics += 1
-            stack = increment_stack(epidemic(stack, turn.epidemic[0]))
-
-            if len(turn.epidemic) == 2:
-                epidemics += 1
-                stack = increment_stack(epidemic(stack, turn.epidemic[1]))
-
-        if turn.exiled:
-            for city_exile in turn.exiled:
-                current_app.logger.debug(
-                    f"city exiled:\t{city_exile.city} ({city_exile.count})"
-                )
 
-                exile_count = city_exile.count
+def get_game_state(game, draw_phase=True):
+    cached = cached_game_state(game, draw_phase)
+    for warning in cached.warnings:
+        flash(warning)
+
+    return cached.state
+
+
+def cached_game_state(game, draw_phase=True):
+    """The ReplayResult for a game, from the cache if possible"""
+    key = game_states.key(game, draw_phase)
+    cached = game_states.get(key)
+    future = precomputing.get(key)
+    if cached is None and future is not None:
+        # already on its way, so wait for it rather than doing it twice
+        try:
+            cached = future.result()
+        except CancelledError:
+            # a speculation that was dropped after all, so it's up to this request
+            pass
+        except Exception:
+            current_app.logger.exception(
+                "Working out game %s's state in the background failed", game.id
+            )
+    if cached is None:
+        snapshots = []
+        cached = compute_game_state(game, draw_phase, snapshots)
+        save_snapshots(snapshots)
+        game_states.put(key, cached)
 
-                for j in range(0, 1 + len(turn.epidemic)):
-                    stack_count = min(exile_count, stack[j][city_exile.city])
-                    stack[j][city_exile.city] -= stack_count
-                    exile_count -= stack_count
-                    if exile_count <= 0:
-                        break
-                else:
-                    flash("WARNING: Couldn't find cities in stack 0 to exile")
+    return cached
 
-                stack[city_exile.to_stack][city_exile.city] += city_exile.count
 
-        if turn.forecasts:
-            current_app.logger.debug("forecast")
+def adopt_game_state(key, future):
+    """Have requests for `key` wait on a future, and cache the result"""
+    precomputing[key] = future
 
-            new_stack = defaultdict(Counter, {s: stack[s] for s in stack if s < 1})
-            for cf in turn.forecasts:
-                new_stack[cf.stack_order][cf.city] += 1
-                j = min(j for j in stack if j > 0 and stack[j][cf.city] > 0)
-                stack[j][cf.city] -= 1
+    def done(future):
+        precomputing.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            game_states.put(key, future.result())
 
-            for j in range(1, max(stack) + 1):
-                new_stack[j + 8] = stack[j]
+    future.add_done_callback(done)
 
-            stack = new_stack
-            # log_stack(stack)
 
-        stack = clean_stack(stack)
+def precompute_game_state(game, draw_phase=True):
+    """
+    Start computing a game state in the background, so the request that needs it
+    next finds it in the cache (or waits for it). Call after committing the turns.
+    """
+    workers = current_app.config["PRECOMPUTE_WORKERS"]
+    if not workers:
+        return
 
-        infected_cities = Counter({ci.city: ci.count for ci in turn.infections})
+    app = current_app._get_current_object()
+    game_id = game.id
 
-        current_app.logger.debug(
-            f"infected:\t{', '.join(city.name for city in infected_cities.elements())}"
+    def compute():
+        with app.app_context():
+            snapshots = []
+            cached = compute_game_state(
+                db.session.get(Game, game_id), draw_phase, snapshots
+            )
+            save_snapshots(snapshots)
+            return cached
+
+    future = get_executor(workers).submit(compute)
+    adopt_game_state(game_states.key(game, draw_phase), future)
+
+
+def save_snapshots(snapshots):
+    """
+    Write snapshots from `compute_game_state` in a transaction of their own, so they
+    keep without committing (and expiring) anything of the request's. Skipped if
+    another request got there first.
+    """
+    if not snapshots:
+        return
+
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(sa.insert(StackSnapshot), snapshots)
+    except IntegrityError:
+        pass
+
+
+def compute_game_state(game, draw_phase, snapshots=None):
+    """
+    The game state and what went into it, replayed from the database. Snapshots of
+    the finished turns are added to `snapshots` (if given), for `save_snapshots`.
+    Traced games are replayed from the start, so the trace has every turn.
+    """
+    snapshot = latest_snapshot(game)
+    saved = snapshot.turn.turn_num if snapshot else None
+    if game.id in traced:
+        snapshot = None
+
+    if snapshot is not None:
+        # resume from the end of the last turn that was already replayed
+        state = Replay(
+            InfectionStack.from_dict(snapshot.stack),
+            snapshot.epidemics,
+            snapshot.skipped_epi,
+            snapshot.ps_cards_drawn,
         )
-
-        while sum(infected_cities.values()):
-            while sum(stack[1].values()) == 0:
-                stack = decrement_stack(stack)
-
-            # all of the infected cities currently in top group
-            possible_cities = infected_cities & stack[1]
-
-            if not len(possible_cities):
-                flash(
-                    "WARNING: looks like a city was infected too early, check records!"
-                )
-                break
-
-            for city in possible_cities.elements():
-                infected_cities[city] -= 1
-                stack[1][city] -= 1
-                stack[0][city] += 1
-
-        while sum(stack[1].values()) == 0:
-            stack = decrement_stack(stack)
-
-    stack = clean_stack(stack)
-
-    log_stack(stack)
-
-    # how many cards are left
-    deck_size = post_setup_deck_size - ps_cards_drawn
-
-    epidemic_stacks = Counter((i % epidemic_cards) for i in range(post_setup_deck_size))
-    epidemic_blocks = list(epidemic_stacks.elements())
-
-    i_block = epidemic_blocks[ps_cards_drawn]
-    j_block = epidemic_blocks[ps_cards_drawn + 1]
-
-    for i in epidemic_blocks[:ps_cards_drawn]:
-        epidemic_stacks[i] -= 1
-
-    if game.turn_num > -1:
-        if i_block < (epidemics + skipped_epi):
-            if j_block < (epidemics + skipped_epi):
-                assert i_block == j_block
-                # this epidemic has already been drawn
-                epidemic_risk = 0.0
-            else:
-                assert epidemic_stacks[i_block] == 1
-                # the second card could be one
-                epidemic_risk = 1.0 / epidemic_stacks[j_block]
-            # next epidemic is in the next block somewhere
-            epidemic_in = epidemic_stacks[i_block] + epidemic_stacks[i_block + 1]
-        elif i_block == j_block:
-            # both are same block, and it hasn't been drawn yet
-            epidemic_risk = 2.0 / epidemic_stacks[i_block]
-            # next epidemic is in this block
-            epidemic_in = epidemic_stacks[i_block]
-        else:
-            # first card is definitely an epidemic, second one might be!
-            assert epidemic_stacks[i_block] == 1
-            epidemic_risk = 1.0 + 1.0 / epidemic_stacks[j_block]
-            # next epidemic is... right now! and then the next block
-            epidemic_in = epidemic_stacks[j_block]
     else:
-        epidemic_risk = 0.0
-        epidemic_in = epidemic_stacks[0]
-
-    epi_stack = -6 if stack[-6] else max(stack)
-    epi_risk = defaultdict(
-        float,
-        {
-            city: stack[epi_stack][city] / sum(stack[epi_stack].values())
-            for city in stack[epi_stack]
-        },
-    )
-
-    inf_risk, hollow_risk = infection_risk(
-        stack, c.infection_rates[epidemics], 1.0 - epidemic_risk
-    )
-
-    epi_inf_risk, epi_hollow_risk = epi_infection_risk(
-        stack, c.infection_rates[epidemics + 1], epidemic_risk, epi_risk
-    )
-
-    city_data = [
-        dict(
-            name=city.name,
-            color=city.color,
-            inf_risk=inf_risk[city],
-            epi_risk=epi_risk[city],
-            epi_inf_risk=epi_inf_risk[city],
+        state = Replay.start(game.turn_num)
+
+    warnings = []
+    before, current = state, None
+    turns = turn_history(game, snapshot.turn.turn_num if snapshot else None)
+    with tracing(game.id):
+        with phase("replay"):
+            for turn in turns:
+                record = turn_record(turn)
+                if turn.turn_num == game.turn_num:
+                    before, current = state.copy(), record
+
+                warnings.extend(state.play(record))
+
+                if (
+                    snapshots is not None
+                    and turn.turn_num < game.turn_num
+                    and (saved is None or turn.turn_num > saved)
+                ):
+                    # this turn is finished, so later requests can start from here
+                    snapshots.append(
+                        dict(
+                            turn_id=turn.id,
+                            stack=state.stack.to_dict(),
+                            epidemics=state.epidemics,
+                            skipped_epi=state.skipped_epi,
+                            ps_cards_drawn=state.ps_cards_drawn,
+                        )
+                    )
+        state_now = game_state(
+            state, game.id, game.turn_num, game.funding_rate, draw_phase
         )
-        for city in c.cities
-        if city != c.hollow_men
-    ]
-
-    return {
-        "game_id": game.id,
-        "turn_num": game.turn_num,
-        "funding": game.funding_rate,
-        "turns": turns,
-        "deck_size": deck_size,
-        "epi_risk": epidemic_risk,
-        "epi_in": epidemic_in,
-        "epidemics": epidemics,
-        "city_data": city_data,
-        "hollow_risk": hollow_risk,
-        "epi_hollow_risk": epi_hollow_risk,
-        "stack": stack,
-    }
+    registry.observe("pandemic_replay_turns", len(turns))
+
+    return ReplayResult(state_now, warnings, before, current)
@@ -0,0 +1,86 @@
+# process-wide tables of binomial coefficients and hypergeometric pmf values, covering
+# every argument the deck in constants.cities can produce. They're built on first use
+# and shared by every request's risk.py calls; anything out of range goes through a
+# bounded cache instead. `cache_stats()` reports on those caches, the tables
+# themselves don't count their lookups so as to keep them cheap (and thread-safe)
+
+import functools
+import math
+import numpy as np
+
+from pandemic import constants as c
+
+# the biggest stack is the whole deck plus an epidemic card
+max_deck = sum(city.infection_cards for city in c.cities) + 1
+max_rate = max(c.infection_rates)
+# the most cards of one city in a stack, again counting an epidemic card
+max_cards = c.max_inf + 1
+# big enough for the negative binomials as well
+max_n = max_deck + max_rate + c.hollow_men.infection_cards
+
+
+@functools.lru_cache(maxsize=None)
+def log_factorial():
+    return np.array([math.lgamma(n + 1) for n in range(max_n + 1)])
+
+
+def log_ncr(n, r):
+    """log(n choose r) for arrays with 0 <= n <= max_n, -inf if r is out of range"""
+    valid = (r >= 0) & (r <= n)
+    n, r = np.where(valid, n, 0), np.where(valid, r, 0)
+    lf = log_factorial()
+    return np.where(valid, lf[n] - lf[r] - lf[n - r], -np.inf)
+
+
+@functools.lru_cache(maxsize=None)
+def ncr_table():
+    return [[float(math.comb(n, r)) for r in range(n + 1)] for n in range(max_n + 1)]
+
+
+@functools.lru_cache(maxsize=None)
+def hg_table():
+    """hg_table()[M, N, n, k] is hg_pmf(k, M, n, N), or zero where n > M"""
+    M, N, n, k = np.ogrid[
+        0 : max_deck + 1, 0 : max_rate + 1, 0 : max_cards + 1, 0 : max_cards + 1
+    ]
+    N = np.minimum(N, M)  # allows for infection rate > stack size
+    with np.errstate(invalid="ignore"):
+        log_p = log_ncr(n, k) + log_ncr(M - n, N - k) - log_ncr(M, N)
+        return np.where(n <= M, np.exp(log_p), 0.0)
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_ncr(n, r):
+    if r < 0 or r > n:
+        return 0.0
+    return float(math.comb(n, r))
+
+
+def ncr(n, r):
+    if 0 <= n <= max_n:
+        return ncr_table()[n][r] if 0 <= r <= n else 0.0
+
+    return cached_ncr(n, r)
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_hg_pmf(k, M, n, N):
+    return ncr(n, k) * ncr(M - n, N - k) / ncr(M, N)
+
+
+def hg_pmf(k, M, n, N):
+    N = min(N, M)  # allows for infection rate > stack size
+    if 0 <= M <= max_deck and 0 <= N <= max_rate and 0 <= n <= max_cards:
+        return hg_table().item(M, N, n, k) if 0 <= k <= max_cards else 0.0
+
+    return cached_hg_pmf(k, M, n, N)
+
+
+def cache_stats():
+    """Hits, misses and sizes of the caches that take the out-of-range lookups"""
+    stats = {}
+    for name, cache in (("ncr", cached_ncr), ("hg_pmf", cached_hg_pmf)):
+        info = cache.cache_info()
+        stats[name] = dict(hits=info.hits, misses=info.misses, size=info.currsize)
+
+    return stats
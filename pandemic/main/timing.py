@@ -0,0 +1,130 @@
+# timing the phases of each request, for a Server-Timing header and a log line.
+# Code marks out what it's doing with `phase`, which is free of Flask (the engine
+# uses it too) and costs a context variable lookup unless a request is being timed.
+# The database's time comes from the query records, and the templates' from
+# Flask's render signals. Each timed request is sent out as `request_timed` too, which
+# is where the metrics get their phases from
+
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from blinker import Namespace
+
+# phase name -> seconds, for the request being timed in this context (if any)
+timings = contextvars.ContextVar("timings", default=None)
+
+# how each phase is described in the header, in the order they're listed
+PHASES = dict(
+    db="Database queries",
+    replay="Replaying turns",
+    risk="Risk calculations",
+    form="Building forms",
+    render="Rendering templates",
+)
+
+# sent with the response, the phase durations (and "total") and the number of queries
+request_timed = Namespace().signal("request-timed")
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to the current request's `name` phase"""
+    current = timings.get()
+    if current is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current[name] = current.get(name, 0.0) + time.perf_counter() - start
+
+
+def server_timing(durations):
+    """A Server-Timing header value for phase name -> seconds"""
+    metrics = []
+    for name, seconds in durations.items():
+        metric = f"{name};dur={seconds * 1e3:.1f}"
+        if name in PHASES:
+            metric += f';desc="{PHASES[name]}"'
+        metrics.append(metric)
+
+    return ", ".join(metrics)
+
+
+def init_app(app):
+    """
+    Time every request, if the config asks for the header, the log line or the
+    metrics
+    """
+    header = app.config["SERVER_TIMING"]
+    log = app.config["SERVER_TIMING_LOG"]
+    if not (header or log or app.config["METRICS"]):
+        return
+
+    from flask import before_render_template, g, request, template_rendered
+    from flask_sqlalchemy.record_queries import get_recorded_queries
+
+    # a child of the app's logger, so the lines go wherever the app's do
+    logger = app.logger.getChild("timing")
+    if log:
+        logger.setLevel(logging.INFO)
+
+    @app.before_request
+    def start_timing():
+        g.timing_start = time.perf_counter()
+        g.timing_token = timings.set({})
+
+    def render_started(sender, **extra):
+        g.render_start = time.perf_counter()
+
+    def render_finished(sender, **extra):
+        current = timings.get()
+        if current is not None and "render_start" in g:
+            current["render"] = current.get("render", 0.0) + (
+                time.perf_counter() - g.pop("render_start")
+            )
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.after_request
+    def finish_timing(response):
+        current = timings.get()
+        if current is None:
+            return response
+
+        queries = get_recorded_queries()
+        current["db"] = sum(query.duration for query in queries)
+        durations = {name: current[name] for name in PHASES if name in current}
+        durations["total"] = time.perf_counter() - g.timing_start
+
+        if header:
+            response.headers["Server-Timing"] = server_timing(durations)
+        if log:
+            logger.info(
+                json.dumps(
+                    dict(
+                        method=request.method,
+                        path=request.path,
+                        endpoint=request.endpoint,
+                        status=response.status_code,
+                        queries=len(queries),
+                        ms={name: round(s * 1e3, 2) for name, s in durations.items()},
+                    )
+                )
+            )
+        request_timed.send(
+            app, response=response, durations=durations, queries=len(queries)
+        )
+
+        return response
+
+    @app.teardown_request
+    def stop_timing(exc):
+        if "timing_token" in g:
+            timings.reset(g.pop("timing_token"))
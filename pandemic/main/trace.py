@@ -0,0 +1,77 @@
+# tracing what the engine does while replaying a game: each turn's epidemics, exiles,
+# forecasts and infections, and the state worked out at the end. The engine reports
+# them to the tracer for the game being replayed, if there is one, which logs them at
+# DEBUG (only formatted if something's listening) and keeps the last few as dicts in
+# a ring buffer, for `/api/game/<id>/trace`. Traced games are replayed from their
+# first turn rather than their latest snapshot, so the events cover the whole game.
+# Like timing.phase this is free of Flask, and a game that isn't traced costs the
+# engine a context variable lookup per turn
+
+import contextvars
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# the Tracer for the game being replayed in this context (if any)
+tracer = contextvars.ContextVar("tracer", default=None)
+
+# the games traced in this process, by id
+traced = {}
+
+
+class Tracer:
+    """Where the engine's events for one game go: the log, and the last `size` kept"""
+
+    def __init__(self, game_id, size):
+        self.game_id = game_id
+        self.events = deque(maxlen=size) if size else None
+
+    def event(self, turn_num, event, **details):
+        logger.debug("game %s, turn %s, %s: %s", self.game_id, turn_num, event, details)
+        if self.events is not None:
+            self.events.append(dict(turn_num=turn_num, event=event, **details))
+
+
+def start(game_id, size):
+    """Trace a game from now on, keeping its last `size` events (0 to only log them)"""
+    traced[game_id] = Tracer(game_id, size)
+
+
+def stop(game_id):
+    traced.pop(game_id, None)
+
+
+def events(game_id):
+    """The events kept for a game, oldest first, or None if it isn't traced"""
+    trace = traced.get(game_id)
+    if trace is None:
+        return None
+    return list(trace.events or ())
+
+
+@contextmanager
+def tracing(game_id):
+    """
+    Send the engine's events in the block to `game_id`'s tracer, or to the log if it
+    isn't traced but the log would take them
+    """
+    trace = traced.get(game_id)
+    if trace is None and logger.isEnabledFor(logging.DEBUG):
+        trace = Tracer(game_id, 0)
+    if trace is None:
+        yield
+        return
+
+    token = tracer.set(trace)
+    try:
+        yield
+    finally:
+        tracer.reset(token)
+
+
+def init_app(app):
+    """Trace the games the config asks for from the start"""
+    for game_id in app.config["TRACE_GAMES"]:
+        start(game_id, app.config["TRACE_EVENTS"])
@@ -1,13 +1,46 @@
 from collections import Counter
 from fractions import Fraction
 
-from flask import flash, redirect, render_template, session, url_for
+from flask import (
+    Response,
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    session,
+    stream_with_context,
+    url_for,
+)
+
+import sqlalchemy as sa
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 from pandemic import constants as c, db
-from pandemic.main import forms, main
-from pandemic.main.state import get_game_state
+from pandemic.main import events, forms, main, trace
+from pandemic.main.horizon import horizon
+from pandemic.main.outlook import outlook
+from pandemic.main.speculate import (
+    speculate_epidemics,
+    speculations,
+    take_speculation,
+)
+from pandemic.main.state import (
+    bump_version,
+    cached_game_state,
+    game_states,
+    get_game_state,
+    invalidate_snapshots,
+    precompute_game_state,
+    rewind,
+)
+from pandemic.main.timing import phase
 from pandemic.models import (
-    Character,
     City,
     CityExile,
     CityForecast,
@@ -15,7 +48,9 @@ from pandemic.models import (
     Game,
     PlayerSession,
     Turn,
+    epidemics,
 )
+from pandemic.registry import db_character_id, db_city_id
 
 
 @main.app_template_filter("to_percent")
@@ -48,7 +83,12 @@ def color_i(color: str):
     return c.color_codes[color]
 
 
-def check_game_id(game_id: int = None):
+def with_characters():
+    # what the views that show the players' characters need loaded with a game
+    return selectinload(Game.characters).joinedload(PlayerSession.character)
+
+
+def check_game_id(game_id: int = None, options=()):
     if not (game_id or session.get("game_id", None)):
         flash("No game in progress", "error")
         return None, None, redirect(url_for(".begin"))
@@ -56,7 +96,7 @@ def check_game_id(game_id: int = None):
         session["game_id"] = game_id
 
     game_id = session["game_id"]
-    game = Game.query.filter_by(id=game_id).one_or_none()
+    game = Game.query.options(*options).filter_by(id=game_id).one_or_none()
     if game is None:
         flash("No game with that ID", "error")
         session["game_id"] = None
@@ -70,22 +110,36 @@ def check_game_id(game_id: int = None):
 
 
 def exile_cities(this_turn: Turn, removed_cities: Counter, to_stack: int):
-    for city_name in removed_cities:
-        city = City.query.filter_by(name=city_name).one()
-        ci = CityExile(
-            city_id=city.id,
-            turn_id=this_turn.id,
-            turn=this_turn,
-            city=city,
-            count=removed_cities[city_name],
-            to_stack=to_stack,
-        )
-        this_turn.exiled.append(ci)
+    db.session.execute(
+        insert(CityExile),
+        [
+            dict(
+                city_id=db_city_id(city_name),
+                turn_id=this_turn.id,
+                count=count,
+                to_stack=to_stack,
+            )
+            for city_name, count in removed_cities.items()
+        ],
+    )
+
+
+def record_epidemics(this_turn: Turn, city_names):
+    # in the order they were drawn, replacing any recorded before
+    db.session.execute(epidemics.delete().where(epidemics.c.turn_id == this_turn.id))
+    db.session.execute(
+        epidemics.insert(),
+        [
+            dict(city_id=db_city_id(city_name), turn_id=this_turn.id)
+            for city_name in city_names
+        ],
+    )
 
 
 @main.route("/", methods=("GET", "POST"))
 def begin():
-    form = forms.BeginForm()
+    with phase("form"):
+        form = forms.BeginForm()
 
     if form.validate_on_submit():
         game = Game(funding_rate=form.funding_rate.data, turn_num=-1)
@@ -93,15 +147,19 @@ def begin():
         db.session.add(game)
         db.session.commit()
 
-        for player_data in form.players.data:
-            player_char = Character.query.filter_by(name=player_data["character"]).one()
-            player = PlayerSession(
-                turn_num=int(player_data["turn_num"]),
-                color_index=int(player_data["color_index"]),
-                game_id=game.id,
-                char_id=player_char.id,
-            )
-            db.session.add(player)
+        db.session.execute(
+            insert(PlayerSession),
+            [
+                dict(
+                    turn_num=int(player_data["turn_num"]),
+                    color_index=int(player_data["color_index"]),
+                    game_id=game.id,
+                    char_id=db_character_id(player_data["character"]),
+                )
+                for player_data in form.players.data
+            ],
+        )
+        db.session.commit()
 
         session["game_id"] = game.id
 
@@ -113,18 +171,29 @@ def begin():
 @main.route("/draw", methods=("GET", "POST"))
 @main.route("/draw/<int:game_id>", methods=("GET", "POST"))
 def draw(game_id: int = None):
-    game, this_turn, redi = check_game_id(game_id)
+    game, this_turn, redi = check_game_id(game_id, options=[with_characters()])
     if redi is not None:
         return redi
 
     if this_turn is None:
         this_turn = Turn(game_id=game.id, turn_num=game.turn_num)
         db.session.add(this_turn)
-        db.session.commit()
+        bump_version(game)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another device at the table started the turn first
+            db.session.rollback()
+            this_turn = Turn.query.filter_by(
+                game_id=game.id, turn_num=game.turn_num
+            ).one()
+        game_states.invalidate(game.id)
 
     game_state = get_game_state(game)
+    base = game_states.key(game, True)
 
-    form = forms.DrawForm(game_state, game.characters)
+    with phase("form"):
+        form = forms.DrawForm(game_state, game.characters)
 
     if form.validate_on_submit():
         if form.exile_cities and form.exile_cities.data:
@@ -135,16 +204,14 @@ def draw(game_id: int = None):
             this_turn.skipped_epi = form.monitor.data["epidemics_seen"]
 
         if form.epidemic and form.epidemic.data:
-            this_turn.epidemic = [City.query.filter_by(name=form.epidemic.data).one()]
+            epidemic_cities = [form.epidemic.data]
             if form.second_epidemic and form.second_epidemic.data:
-                this_turn.epidemic.append(
-                    City.query.filter_by(name=form.second_epidemic.data).one()
-                )
-                max_s = 2
-            else:
-                max_s = 1
+                epidemic_cities.append(form.second_epidemic.data)
+            record_epidemics(this_turn, epidemic_cities)
         else:
-            max_s = 0
+            epidemic_cities = []
+
+        max_s = len(epidemic_cities)
 
         city_flag = (
             forms.auth_valid(form.resilient_population)
@@ -155,7 +222,12 @@ def draw(game_id: int = None):
 
         do_forecast = forms.auth_valid(form.city_forecast)
 
+        invalidate_snapshots(game.id, this_turn.turn_num)
+        bump_version(game)
         db.session.commit()
+        game_states.invalidate(game.id)
+        take_speculation(game, base, this_turn)
+        events.publish_change(game, draw_phase=False)
 
         if city_flag > 0:
             # less precise but easier to code version: show all the cities up to
@@ -173,8 +245,19 @@ def draw(game_id: int = None):
         else:
             return redirect(url_for(".infect"))
 
+    speculate_epidemics(game)
+
     return render_template(
-        "draw.html", title="Draw Cards", game_state=game_state, form=form
+        "draw.html",
+        title="Draw Cards",
+        game_state=game_state,
+        # fetched by the page, rather than sampled while it waits
+        outlook_url=(
+            url_for(".game_outlook", game_id=game.id)
+            if current_app.config["OUTLOOK_TURNS"] and game.turn_num > -1
+            else None
+        ),
+        form=form,
     )
 
 
@@ -197,7 +280,8 @@ def removecity(max_stack: int = 0, city_flag: int = 1, also_forecast: int = 0):
 
     game_state = get_game_state(game)
 
-    form = forms.RemoveCityForm(game_state, max_stack, city_flag)
+    with phase("form"):
+        form = forms.RemoveCityForm(game_state, max_stack, city_flag)
 
     if form.validate_on_submit():
         if form.game.data != game.id:
@@ -206,7 +290,11 @@ def removecity(max_stack: int = 0, city_flag: int = 1, also_forecast: int = 0):
 
         exile_cities(this_turn, Counter(form.cities.data), -6 if city_flag & 8 else -1)
 
+        invalidate_snapshots(game.id, this_turn.turn_num)
+        bump_version(game)
         db.session.commit()
+        game_states.invalidate(game.id)
+        events.publish_change(game, draw_phase=False)
 
         if city_flag & 8 and city_flag - 8:
             return redirect(
@@ -248,25 +336,32 @@ def forecast():
 
     game_state = get_game_state(game, draw_phase=False)
 
-    form = forms.ForecastForm(game_state)
+    with phase("form"):
+        form = forms.ForecastForm(game_state)
 
     if form.validate_on_submit():
         if form.game.data != game.id:
             flash("Game ID did not match session", "error")
             return redirect(url_for(".begin"))
 
-        for fc in form.forecast_cities.data:
-            city = City.query.filter_by(name=fc["city_name"]).one()
-            cf = CityForecast(
-                city_id=city.id,
-                turn_id=this_turn.id,
-                turn=this_turn,
-                city=city,
-                stack_order=int(fc["stack_order"]) + 1,
+        if form.forecast_cities.data:
+            db.session.execute(
+                insert(CityForecast),
+                [
+                    dict(
+                        city_id=db_city_id(fc["city_name"]),
+                        turn_id=this_turn.id,
+                        stack_order=int(fc["stack_order"]) + 1,
+                    )
+                    for fc in form.forecast_cities.data
+                ],
             )
-            this_turn.forecasts.append(cf)
 
+        invalidate_snapshots(game.id, this_turn.turn_num)
+        bump_version(game)
         db.session.commit()
+        game_states.invalidate(game.id)
+        events.publish_change(game, draw_phase=False)
 
         return redirect(url_for(".infect"))
 
@@ -278,7 +373,7 @@ def forecast():
 @main.route("/infect", methods=("GET", "POST"))
 @main.route("/infect/<int:game_id>", methods=("GET", "POST"))
 def infect(game_id: int = None):
-    game, this_turn, redi = check_game_id(game_id)
+    game, this_turn, redi = check_game_id(game_id, options=[with_characters()])
 
     if this_turn is None:
         flash("Not on the infection step right now", "error")
@@ -286,10 +381,11 @@ def infect(game_id: int = None):
 
     game_state = get_game_state(game, draw_phase=False)
 
-    if game.turn_num == -1:
-        form = forms.SetupInfectForm(game_state)
-    else:
-        form = forms.InfectForm(game_state, game.characters)
+    with phase("form"):
+        if game.turn_num == -1:
+            form = forms.SetupInfectForm(game_state)
+        else:
+            form = forms.InfectForm(game_state, game.characters)
 
     if form.validate_on_submit():
         if form.game.data != game.id:
@@ -297,20 +393,25 @@ def infect(game_id: int = None):
             return redirect(url_for(".begin"))
 
         infected_cities = Counter(form.cities.data)
-
-        for city_name in infected_cities:
-            city = City.query.filter_by(name=city_name).one()
-            ci = CityInfection(
-                city_id=city.id,
-                turn_id=this_turn.id,
-                turn=this_turn,
-                city=city,
-                count=infected_cities[city_name],
+        if infected_cities:
+            db.session.execute(
+                insert(CityInfection),
+                [
+                    dict(city_id=db_city_id(city_name), turn_id=this_turn.id, count=n)
+                    for city_name, n in infected_cities.items()
+                ],
             )
-            this_turn.infections.append(ci)
 
+        invalidate_snapshots(game.id, this_turn.turn_num)
         game.turn_num += 1
+        bump_version(game)
+        # start the next turn here, so its state can be worked out while the
+        # players move on to the draw page
+        db.session.add(Turn(game_id=game.id, turn_num=game.turn_num))
         db.session.commit()
+        game_states.invalidate(game.id)
+        precompute_game_state(game)
+        events.publish_change(game, draw_phase=True)
 
         return redirect(url_for(".draw"))
 
@@ -319,15 +420,81 @@ def infect(game_id: int = None):
     )
 
 
+def game_summaries(before: int = None, limit: int = 50):
+    """
+    One row per game, newest first and starting below game id `before`: the game's
+    columns plus its turn count, epidemics so far and the cities infected on the
+    last turn that had any, all worked out in a single query
+    """
+    turns = (
+        sa.select(sa.func.count(Turn.id))
+        .where(Turn.game_id == Game.id)
+        .scalar_subquery()
+    )
+    game_epidemics = (
+        sa.select(sa.func.count())
+        .select_from(epidemics.join(Turn, epidemics.c.turn_id == Turn.id))
+        .where(Turn.game_id == Game.id)
+        .scalar_subquery()
+    )
+    last_turn = (
+        sa.select(sa.func.max(Turn.turn_num))
+        .join(CityInfection, CityInfection.turn_id == Turn.id)
+        .where(Turn.game_id == Game.id)
+        # the game is two queries out, which doesn't get correlated by itself
+        .correlate(Game)
+        .scalar_subquery()
+    )
+    last_infected = (
+        sa.select(sa.func.aggregate_strings(City.name, ", "))
+        .select_from(Turn)
+        .join(CityInfection, CityInfection.turn_id == Turn.id)
+        .join(City, City.id == CityInfection.city_id)
+        .where(Turn.game_id == Game.id, Turn.turn_num == last_turn)
+        .scalar_subquery()
+    )
+
+    query = sa.select(
+        Game.id,
+        Game.funding_rate,
+        Game.turn_num,
+        turns.label("turns"),
+        game_epidemics.label("epidemics"),
+        last_infected.label("last_infected"),
+    ).order_by(Game.id.desc())
+    if before is not None:
+        query = query.where(Game.id < before)
+
+    return db.session.execute(query.limit(limit)).all()
+
+
 @main.route("/history")
 def history():
-    games = Game.query.all()
-    return render_template("summaries.html", games=games)
+    page_size = current_app.config["HISTORY_PAGE_SIZE"]
+    before = request.args.get("before", type=int)
+
+    # one extra row to tell if there's another page
+    games = game_summaries(before, page_size + 1)
+    older = games[page_size - 1].id if len(games) > page_size else None
+
+    return render_template(
+        "summaries.html", games=games[:page_size], older=older, paged=before
+    )
 
 
 @main.route("/history/<int:game_id>")
 def game_history(game_id: int):
-    game = Game.query.filter_by(id=game_id).one_or_none()
+    game = (
+        Game.query.options(
+            with_characters(),
+            selectinload(Game.turns).options(
+                selectinload(Turn.epidemic),
+                selectinload(Turn.infections).joinedload(CityInfection.city),
+            ),
+        )
+        .filter_by(id=game_id)
+        .one_or_none()
+    )
     if game is None:
         flash("No game with that ID", "error")
         return redirect(url_for(".history"))
@@ -340,27 +507,22 @@ def game_history(game_id: int):
 @main.route("/replay/<int:game_id>/<turn_num>", methods=("GET", "POST"))
 def replay(game_id: int, turn_num: str):
     turn_num = int(turn_num)
-    game = Game.query.filter_by(id=game_id).one_or_none()
+    game = Game.query.options(with_characters()).filter_by(id=game_id).one_or_none()
     if game is None:
         flash("No game with that ID", "error")
         return redirect(url_for(".begin"))
 
-    form = forms.ReplayForm(game_id, game.characters)
+    with phase("form"):
+        form = forms.ReplayForm(game_id, game.characters)
 
     if form.validate_on_submit():
         if forms.auth_valid(form.authorize):
             session["game_id"] = game_id
-            game.turn_num = turn_num
-
-            turns = (
-                Turn.query.filter_by(game_id=game.id)
-                .filter(Turn.turn_num >= turn_num)
-                .all()
-            )
-            for turn in turns:
-                db.session.delete(turn)
-
+            rewind(game, turn_num)
             db.session.commit()
+            game_states.invalidate(game.id)
+            speculations.discard(game.id)
+            events.publish_change(game, draw_phase=True)
 
             return redirect(url_for(".draw"))
         else:
@@ -368,3 +530,156 @@ def replay(game_id: int, turn_num: str):
             return redirect(url_for(".game_history", game_id=form.game.data))
 
     return render_template("base_form.html", title="Redo Turn", form=form)
+
+
+@main.route("/api/game/<int:game_id>/state")
+def api_game_state(game_id: int):
+    """
+    The game state as JSON, for polling. `?phase=infect` gives the infection step's
+    state instead of the draw step's. Sends 304 while the game's version in the
+    database hasn't changed, whichever process is asked.
+    """
+    game = Game.query.filter_by(id=game_id).one_or_none()
+    if game is None:
+        abort(404)
+
+    draw_phase = request.args.get("phase", "draw") != "infect"
+    etag = game_states.etag(game_states.key(game, draw_phase))
+
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        cached = cached_game_state(game, draw_phase)
+        game_state = cached.state
+        response = jsonify(
+            game_id=game.id,
+            turn_num=game.turn_num,
+            deck_size=game_state["deck_size"],
+            epi_risk=game_state["epi_risk"],
+            city_data=game_state["city_data"],
+            hollow_risk=game_state["hollow_risk"],
+            stack=game_state["stack"].to_dict(),
+            warnings=cached.warnings,
+        )
+
+    response.set_etag(etag)
+    # always check back, it's cheap
+    response.cache_control.no_cache = True
+    return response
+
+
+@main.route("/api/game/<int:game_id>/outlook")
+def game_outlook(game_id: int):
+    """
+    Sampled risks over the next OUTLOOK_TURNS turns from the draw step, as JSON: the
+    chance of each city being infected (most likely first) and of each number of
+    hollow men drawn. Sampled once per version of the game, and kept with its states.
+    """
+    turns = current_app.config["OUTLOOK_TURNS"]
+    game = Game.query.filter_by(id=game_id).one_or_none()
+    # nothing to sample before the setup infections
+    if not turns or game is None or game.turn_num == -1:
+        abort(404)
+
+    key = game_states.key(game, True) + ("outlook",)
+    result = game_states.get(key)
+    if result is None:
+        with phase("risk"):
+            sampled = outlook(
+                cached_game_state(game, True).state,
+                turns=turns,
+                time_budget=current_app.config["OUTLOOK_TIME_BUDGET"],
+                tolerance=current_app.config["OUTLOOK_TOLERANCE"],
+                workers=current_app.config["OUTLOOK_WORKERS"],
+            )
+        cities = sorted(
+            ((city, p) for city, p in sampled["p_infected"].items() if p > 0),
+            key=lambda city_p: -city_p[1],
+        )
+        result = dict(
+            turns=turns,
+            samples=sampled["samples"],
+            cities=[
+                dict(name=c.cities[city].name, color=c.cities[city].color, p=p)
+                for city, p in cities
+            ],
+            hollow_men=sampled["hollow_men"],
+        )
+        game_states.put(key, result)
+
+    return jsonify(game_id=game.id, turn_num=game.turn_num, **result)
+
+
+@main.route("/api/game/<int:game_id>/horizon")
+def game_horizon(game_id: int):
+    """
+    The exact chance of each city being infected over the next `?turns=` turns (up
+    to HORIZON_TURNS) and of each number of hollow men drawn, as JSON. `dropped` is
+    how much probability was left out to keep it quick.
+    """
+    max_turns = current_app.config["HORIZON_TURNS"]
+    turns = request.args.get("turns", max_turns, type=int)
+    if not 1 <= turns <= max_turns:
+        abort(400)
+
+    game = Game.query.filter_by(id=game_id).one_or_none()
+    if game is None:
+        abort(404)
+
+    game_state = cached_game_state(game, True).state
+    with phase("risk"):
+        result = horizon(
+            game_state,
+            turns=turns,
+            max_states=current_app.config["HORIZON_MAX_STATES"],
+        )
+
+    return jsonify(
+        game_id=game.id,
+        turn_num=game.turn_num,
+        turns=turns,
+        p_infected={c.cities[city].name: p for city, p in result["p_infected"].items()},
+        hollow_men=result["hollow_men"],
+        dropped=result["dropped"],
+    )
+
+
+@main.route("/api/game/<int:game_id>/events")
+def game_events(game_id: int):
+    """
+    A server-sent event stream of changes to the game state, starting with the
+    draw step's (or the infection step's, for `?phase=infect`)
+    """
+    if Game.query.filter_by(id=game_id).one_or_none() is None:
+        abort(404)
+
+    draw_phase = request.args.get("phase", "draw") != "infect"
+    keepalive = current_app.config["EVENT_KEEPALIVE"]
+    return Response(
+        stream_with_context(events.stream(game_id, draw_phase, keepalive)),
+        mimetype="text/event-stream",
+        # don't let proxies hold the events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@main.route("/api/game/<int:game_id>/trace", methods=("GET", "POST", "DELETE"))
+def game_trace(game_id: int):
+    """
+    The latest events from replaying the game, as JSON, if it's being traced. POST
+    starts tracing it and DELETE stops, in this process only. The next request for
+    its state after a POST replays every turn.
+    """
+    if Game.query.filter_by(id=game_id).one_or_none() is None:
+        abort(404)
+
+    if request.method == "POST":
+        if trace.events(game_id) is None:
+            trace.start(game_id, current_app.config["TRACE_EVENTS"])
+        # so the next request replays it
+        game_states.invalidate(game_id)
+    elif request.method == "DELETE":
+        trace.stop(game_id)
+
+    kept = trace.events(game_id)
+    return jsonify(game_id=game_id, tracing=kept is not None, events=kept or [])
@@ -23,7 +23,11 @@ class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     funding_rate = db.Column(db.Integer, nullable=False)  # funding rate
     turn_num = db.Column(db.Integer, nullable=False)  # the current turn
-    turns = db.relationship("Turn", backref="game", lazy="subquery")
+    # goes up with every write to the turns (see state.bump_version), so anything
+    # worked out from them can be keyed by it, in any process
+    version = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # load these explicitly where they're needed, most views only want `turn_num`
+    turns = db.relationship("Turn", backref="game", lazy=True, order_by="Turn.turn_num")
 
     def __repr__(self):
         return f"<Game {self.id}, Turn {self.turn_num}, FR {self.funding_rate}>"
@@ -56,6 +60,8 @@ epidemics = db.Table(
     "epidemics",
     db.Column("city_id", db.Integer, db.ForeignKey("cities.id"), primary_key=True),
     db.Column("turn_id", db.Integer, db.ForeignKey("turns.id"), primary_key=True),
+    # the primary key leads with the city, but turns load their epidemics
+    db.Index("ix_epidemics_turn_id", "turn_id"),
 )
 
 
@@ -129,6 +135,25 @@ class CityForecast(db.Model):
         return f"<{self.city.name} forecast to #{self.stack_order}>"
 
 
+class StackSnapshot(db.Model):
+    __tablename__ = "snapshots"
+    turn_id = db.Column(db.Integer, db.ForeignKey("turns.id"), primary_key=True)
+    stack = db.Column(db.JSON, nullable=False)  # {stack index: {city name: count}}
+    epidemics = db.Column(db.Integer, nullable=False)  # epidemics so far
+    skipped_epi = db.Column(db.Integer, nullable=False)  # epidemics skipped so far
+    ps_cards_drawn = db.Column(db.Integer, nullable=False)  # post-setup cards drawn
+
+    turn = db.relationship(
+        "Turn",
+        backref=db.backref("snapshot", uselist=False, cascade="all, delete-orphan"),
+        lazy=True,
+        viewonly=True,
+    )
+
+    def __repr__(self):
+        return f"<Snapshot after turn {self.turn.turn_num}>"
+
+
 class City(db.Model):
     __tablename__ = "cities"
     id = db.Column(db.Integer, primary_key=True)
@@ -156,6 +181,9 @@ class City(db.Model):
 
 class Turn(db.Model):
     __tablename__ = "turns"
+    __table_args__ = (
+        db.Index("ix_turns_game_id_turn_num", "game_id", "turn_num", unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     turn_num = db.Column(db.Integer)  # which turn this is
     game_id = db.Column(db.Integer, db.ForeignKey("games.id"), nullable=False)
@@ -0,0 +1,40 @@
+# canonical integer ids for the cities, which the state and risk engines use as keys.
+# an id is the city's position in constants.cities, so c.cities[i] translates back
+
+from . import constants as c
+
+city_ids = {city.name: i for i, city in enumerate(c.cities)}
+hollow_men_id = city_ids[c.hollow_men.name]
+
+
+def city_id(city):
+    """The id for a constants.City or a models.City"""
+    return city_ids[city.name]
+
+
+# the database ids of the cities and characters by name. Those tables don't change
+# after initdb, so they're read once per process (and again by initdb)
+db_ids = None
+
+
+def load_db_ids():
+    from . import db
+    from .models import Character, City
+
+    global db_ids
+    db_ids = dict(
+        cities=dict(db.session.query(City.name, City.id)),
+        characters=dict(db.session.query(Character.name, Character.id)),
+    )
+
+
+def db_city_id(name):
+    if db_ids is None:
+        load_db_ids()
+    return db_ids["cities"][name]
+
+
+def db_character_id(name):
+    if db_ids is None:
+        load_db_ids()
+    return db_ids["characters"][name]
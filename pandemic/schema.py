@@ -0,0 +1,88 @@
+# bringing databases made by older versions up to date. Tables (such as the
+# snapshots), columns with defaults (such as the games' versions) and indexes have
+# only been added since, so this creates whichever of them are missing
+
+import sqlalchemy as sa
+
+from . import db
+
+
+def missing_tables(bind):
+    """The tables the models declare that the database doesn't have yet"""
+    tables = set(sa.inspect(bind).get_table_names())
+    return [table for table in db.metadata.sorted_tables if table.name not in tables]
+
+
+def missing_columns(bind):
+    """The columns the models declare that the database's existing tables lack"""
+    inspector = sa.inspect(bind)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(
+            column for column in table.columns if column.name not in existing
+        )
+
+    return missing
+
+
+def add_column(bind, column):
+    """ALTER TABLE ... ADD COLUMN, which needs a server default if it's NOT NULL"""
+    table = bind.dialect.identifier_preparer.format_table(column.table)
+    definition = sa.schema.CreateColumn(column).compile(dialect=bind.dialect)
+    with bind.begin() as connection:
+        connection.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN {definition}"))
+
+
+def missing_indexes(bind):
+    """
+    The indexes the models declare that the database doesn't have yet, on the
+    tables it does have
+    """
+    inspector = sa.inspect(bind)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in table.indexes if index.name not in existing)
+
+    return missing
+
+
+def duplicate_turns(bind):
+    """(game_id, turn_num, count) for turns recorded more than once"""
+    from .models import Turn
+
+    query = (
+        sa.select(Turn.game_id, Turn.turn_num, sa.func.count())
+        .group_by(Turn.game_id, Turn.turn_num)
+        .having(sa.func.count() > 1)
+    )
+    with bind.connect() as connection:
+        return connection.execute(query).all()
+
+
+def upgrade(bind):
+    """Create the missing tables, columns and indexes, returning what was created"""
+    tables = missing_tables(bind)
+    columns = missing_columns(bind)
+    indexes = missing_indexes(bind)
+    # with their own indexes
+    db.metadata.create_all(bind, tables=tables)
+    for column in columns:
+        add_column(bind, column)
+    for index in indexes:
+        index.create(bind)
+
+    return (
+        [f"table {table.name}" for table in tables]
+        + [f"column {column.table.name}.{column.name}" for column in columns]
+        + [f"index {index.name}" for index in indexes]
+    )
@@ -12,6 +12,7 @@ setup(
         "Flask-Bootstrap",
         "Flask-WTF",
         "Flask-nav",
+        "numpy",
         "wtforms",
     ],
 )
@@ -0,0 +1,41 @@
+import pytest
+
+from pandemic import create_app, db, init_db
+from config import TestingConfig, config
+
+from benchmarks.games import load, synthetic_games
+
+
+@pytest.fixture
+def app(tmp_path):
+    class PytestConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = "sqlite:///" + str(tmp_path / "test.sqlite")
+        SQLALCHEMY_RECORD_QUERIES = True
+        WTF_CSRF_ENABLED = False
+        # just the request itself, with nothing left running in the background
+        OUTLOOK_TURNS = 0
+        PRECOMPUTE_WORKERS = 0
+        SPECULATE_BUDGET = 0
+
+    config["pytest"] = PytestConfig
+    app = create_app("pytest")
+    with app.app_context():
+        init_db()
+
+    # requests push their own context, with a session of their own
+    yield app
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def load_games(app):
+    """Load seeded synthetic games of the given lengths, returning their ids"""
+
+    def load_games(*turns, seed=0):
+        games = [synthetic_games(seed + i, 1, n)[0] for i, n in enumerate(turns)]
+        with app.app_context(), db.engine.begin() as connection:
+            return load(connection, games)
+
+    return load_games
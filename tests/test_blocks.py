@@ -0,0 +1,33 @@
+import pytest
+
+from pandemic.main.blocks import EpidemicBlocks
+
+
+def test_blocks():
+    blocks = EpidemicBlocks(11, 4)
+
+    # the first 11 % 4 blocks get the extra card
+    assert [blocks.size(block) for block in range(4)] == [3, 3, 3, 2]
+    assert list(map(blocks.block, range(12))) == [0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 4]
+    assert blocks.remaining_blocks(4) == [2, 3, 2]
+
+
+@pytest.mark.parametrize(
+    "drawn, epidemics, risk",
+    [
+        # both cards in block 1, which hasn't had its epidemic
+        (3, 1, (2 / 3, 3)),
+        # the last card of block 1, which has, and the first of block 2
+        (5, 2, (1 / 3, 4)),
+        # the last card of block 1, which hasn't, and the first of block 2
+        (5, 1, (1 + 1 / 3, 3)),
+        # both cards in block 1, which has
+        (3, 2, (0.0, 6)),
+        # the last card of block 1 and the first of block 2, which both have
+        (5, 3, (0.0, 6)),
+        (11, 4, (0.0, 0)),
+    ],
+)
+def test_epidemic_risk(drawn, epidemics, risk):
+    blocks = EpidemicBlocks(11, 4)
+    assert blocks.epidemic_risk(drawn, epidemics) == pytest.approx(risk)
@@ -0,0 +1,26 @@
+from concurrent.futures import Future
+
+from pandemic.main.cache import SpeculativeStates
+
+
+def test_speculations_kept_on_reload():
+    speculations = SpeculativeStates()
+    submitted = []
+
+    def submit(outcome):
+        submitted.append(outcome)
+        return Future()
+
+    base = (1, 5, True, 0)
+    speculations.start(base, [(), (3,)], submit, budget=8)
+    futures = dict(speculations.entries[base])
+    # the draw page asked for again, with nothing recorded
+    speculations.start(base, [(), (3,)], submit, budget=8)
+
+    assert submitted == [(), (3,)]
+    assert not any(future.cancelled() for future in futures.values())
+
+    # a new version of the game's history starts over
+    speculations.start((1, 5, True, 1), [()], submit, budget=8)
+    assert submitted == [(), (3,), ()]
+    assert all(future.cancelled() for future in futures.values())
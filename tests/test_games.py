@@ -0,0 +1,5 @@
+def test_load_many(load_games):
+    # long enough that some turns exile to box six and out of the game both, which
+    # have to be different cities
+    game_ids = load_games(*[80] * 40)
+    assert len(set(game_ids)) == 40
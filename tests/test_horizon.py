@@ -0,0 +1,51 @@
+import pytest
+
+from benchmarks.games import synthetic_games
+from pandemic import constants as c
+from pandemic.main.engine import Replay, game_state
+from pandemic.main.horizon import horizon
+from pandemic.main.risk import infection_risk
+from pandemic.registry import hollow_men_id
+
+
+def draw_steps(seed, games, turns):
+    """The draw step state of each turn of some seeded synthetic games"""
+    for game in synthetic_games(seed, games, turns):
+        replay = Replay.start(len(game.turns) - 1)
+        for turn in game.turns:
+            replay.play(turn)
+            yield game_state(replay.copy(), 0, turn.turn_num + 1, game.funding_rate)
+
+
+def reached(stack, infection_rate):
+    """The stacks this many infections draw from, top first"""
+    for i in range(1, stack.max_stack + 1):
+        if infection_rate <= 0:
+            break
+        yield i
+        infection_rate -= stack.size(i) - stack.count(i, hollow_men_id)
+
+
+def test_one_turn():
+    # risk.py leaves the epidemic card itself out of a city's risk, so compare the
+    # turns with no epidemic to come, where the infections are all there is. It also
+    # gives each stack's chances separately, which only add up to the chance of
+    # being infected for the cities in at most one of the stacks drawn from
+    compared = 0
+    for state in draw_steps(0, 4, 60):
+        if state["epi_risk"]:
+            continue
+
+        stack = state["stack"]
+        infection_rate = c.infection_rates[state["epidemics"]]
+        inf_risk, _ = infection_risk(stack, infection_rate, 1.0)
+        stacks = list(reached(stack, infection_rate))
+
+        result = horizon(state, turns=1, threshold=0.0)
+        assert result["dropped"] == 0
+        for city, p in result["p_infected"].items():
+            if sum(1 for i in stacks if stack.count(i, city)) <= 1:
+                assert p == pytest.approx(sum(inf_risk[city]), abs=1e-9)
+                compared += 1
+
+    assert compared > 1000
@@ -0,0 +1,13 @@
+from pandemic.main.speculate import epidemic_outcomes
+from pandemic.main.stack import InfectionStack
+
+
+def test_epidemic_pairs():
+    stack = InfectionStack()
+    stack.add(2, 0, 3)
+    stack.add(2, 1, 1)
+    outcomes = epidemic_outcomes(dict(turn_num=5, epi_risk=1.5, stack=stack))
+
+    # of the 12 ways to draw two of the four cards, 6 are city 0 twice and 3 each
+    # are the two cities in either order. City 1 can't come up twice
+    assert outcomes == [(), (0,), (1,), (0, 0), (0, 1), (1, 0)]
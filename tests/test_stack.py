@@ -0,0 +1,75 @@
+from pandemic.main.stack import InfectionStack
+
+ATLANTA, CHICAGO, JOHANNESBURG, LONDON = range(4)
+
+
+def stack_of(data):
+    stack = InfectionStack()
+    for i, cities in data.items():
+        for city, n in cities.items():
+            stack.add(i, city, n)
+    return stack
+
+
+def as_dict(stack):
+    return {i: dict(stack.items(i)) for i in stack.stacks()}
+
+
+def test_dict_round_trip():
+    stack = stack_of({-6: {LONDON: 1}, 0: {ATLANTA: 2}, 1: {CHICAGO: 1}})
+    assert stack.to_dict() == {-6: {"London": 1}, 0: {"Atlanta": 2}, 1: {"Chicago": 1}}
+    assert as_dict(InfectionStack.from_dict(stack.to_dict())) == as_dict(stack)
+
+
+def test_epidemic():
+    stack = stack_of({0: {LONDON: 1}, 1: {ATLANTA: 1}, 2: {CHICAGO: 2}})
+    assert stack.epidemic(CHICAGO)
+    # the bottom card goes on the discard pile, which goes on top
+    assert as_dict(stack) == {
+        1: {LONDON: 1, CHICAGO: 1},
+        2: {ATLANTA: 1},
+        3: {CHICAGO: 1},
+    }
+
+    # box six comes first
+    stack.add(-6, JOHANNESBURG)
+    assert stack.epidemic(JOHANNESBURG)
+    assert stack.size(-6) == 0
+    assert stack.count(1, JOHANNESBURG) == 1
+
+    # not at the bottom, so only the intensify happens
+    assert not stack.epidemic(LONDON)
+    assert as_dict(stack) == {
+        2: {JOHANNESBURG: 1},
+        3: {LONDON: 1, CHICAGO: 1},
+        4: {ATLANTA: 1},
+        5: {CHICAGO: 1},
+    }
+
+
+def test_infect():
+    stack = stack_of({1: {ATLANTA: 1, CHICAGO: 1}, 2: {ATLANTA: 1, LONDON: 2}})
+
+    # the top stack runs out, and the next one takes its place
+    assert stack.infect(stack.vector({ATLANTA: 2, CHICAGO: 1}))
+    assert as_dict(stack) == {0: {ATLANTA: 2, CHICAGO: 1}, 1: {LONDON: 2}}
+
+    assert not stack.infect(stack.vector({CHICAGO: 1}))
+
+
+def test_forecast():
+    stack = stack_of({1: {ATLANTA: 1, CHICAGO: 1}, 2: {LONDON: 1}})
+    stack.forecast([(LONDON, 1), (ATLANTA, 2)])
+
+    # one stack per forecast card, above the rest of the pile
+    assert as_dict(stack) == {1: {LONDON: 1}, 2: {ATLANTA: 1}, 9: {CHICAGO: 1}}
+
+
+def test_exile():
+    stack = stack_of({0: {ATLANTA: 1}, 1: {ATLANTA: 1, CHICAGO: 1}})
+    assert stack.exile(ATLANTA, 2, 1, -1)
+    assert as_dict(stack) == {-1: {ATLANTA: 2}, 1: {CHICAGO: 1}}
+
+    # not in the discard pile
+    assert not stack.exile(CHICAGO, 1, 0, -6)
+    assert stack.count(-6, CHICAGO) == 1
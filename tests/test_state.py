@@ -0,0 +1,159 @@
+from concurrent.futures import Future
+
+import pytest
+from flask_sqlalchemy.record_queries import get_recorded_queries
+
+from pandemic import db
+from pandemic.main import state
+from pandemic.main.cache import GameStateCache
+from pandemic.main.engine import Replay, game_state
+from pandemic.main.state import (
+    bump_version,
+    cached_game_state,
+    compute_game_state,
+    game_states,
+    latest_snapshot,
+    precomputing,
+    rewind,
+    save_snapshots,
+    turn_history,
+    turn_record,
+)
+from pandemic.models import CityInfection, Game, Turn
+
+
+def count_queries(fn):
+    """What `fn()` returns, and how many queries it made"""
+    before = len(get_recorded_queries())
+    result = fn()
+    return result, len(get_recorded_queries()) - before
+
+
+def test_turn_history_queries(app, load_games):
+    # everything the replay reads from the turns comes in a fixed number of
+    # queries, however long the game
+    counts = {}
+    for game_id in load_games(3, 40):
+        with app.app_context():
+            game = db.session.get(Game, game_id)
+            records, queries = count_queries(
+                lambda: [turn_record(turn) for turn in turn_history(game)]
+            )
+            counts[len(records)] = queries
+
+    short, long = sorted(counts)
+    assert long > 4 * short
+    assert counts[short] == counts[long] == 5
+
+
+def full_replay(game):
+    """The draw step state, replayed from the setup turn without any snapshots"""
+    replay = Replay.start(game.turn_num)
+    for turn in turn_history(game):
+        replay.play(turn_record(turn))
+    return game_state(replay, game.id, game.turn_num, game.funding_rate)
+
+
+def same_state(a, b):
+    assert a["stack"].to_dict() == b["stack"].to_dict()
+    for name in ("deck_size", "epi_risk", "epi_in", "city_data", "hollow_risk"):
+        assert a[name] == b[name], name
+
+
+def test_snapshot_resume(app, load_games, monkeypatch):
+    (game_id,) = load_games(30)
+    with app.app_context():
+        game = db.session.get(Game, game_id)
+        snapshots = []
+        replayed = compute_game_state(game, True, snapshots)
+        save_snapshots(snapshots)
+        # every finished turn, the setup turn included
+        assert len(snapshots) == game.turn_num + 1
+        assert latest_snapshot(game).turn.turn_num == game.turn_num - 1
+
+        resumed_after = []
+
+        def history(game, after=None):
+            resumed_after.append(after)
+            return turn_history(game, after)
+
+        monkeypatch.setattr(state, "turn_history", history)
+        snapshots = []
+        resumed = compute_game_state(game, True, snapshots)
+        # only the current turn was replayed, and there was nothing new to save
+        assert resumed_after == [game.turn_num - 1]
+        assert not snapshots
+
+        expected = full_replay(game)
+        same_state(replayed.state, expected)
+        same_state(resumed.state, expected)
+        assert resumed.turn == replayed.turn
+        assert resumed.before.stack.to_dict() == replayed.before.stack.to_dict()
+
+
+def test_rewind(app, load_games):
+    # the same seed, so the shorter game is how the longer one started
+    (long_id,) = load_games(20, seed=3)
+    (short_id,) = load_games(8, seed=3)
+    with app.app_context():
+        game = db.session.get(Game, long_id)
+        snapshots = []
+        compute_game_state(game, True, snapshots)
+        save_snapshots(snapshots)
+        version = game.version
+
+        rewind(game, 8)
+        # as the draw page starts the turn again
+        db.session.add(Turn(game_id=long_id, turn_num=8))
+        db.session.commit()
+        game_states.invalidate(long_id)
+
+        assert game.version == version + 1
+        assert [turn.turn_num for turn in turn_history(game)] == list(range(-1, 9))
+        assert latest_snapshot(game).turn.turn_num == 7
+        assert (
+            not CityInfection.query.join(Turn)
+            .filter(Turn.game_id == long_id, Turn.turn_num >= 8)
+            .count()
+        )
+
+        short = db.session.get(Game, short_id)
+        same_state(cached_game_state(game).state, full_replay(short))
+
+
+def test_version_keys_other_processes(app, load_games):
+    (game_id,) = load_games(5)
+    with app.app_context():
+        game = db.session.get(Game, game_id)
+        before = game_states.key(game, True)
+        bump_version(game)
+        db.session.commit()
+
+    # a fresh cache and session, as another worker process would have
+    with app.app_context():
+        after = GameStateCache().key(db.session.get(Game, game_id), True)
+    assert after == before[:3] + (before[3] + 1,)
+
+
+@pytest.mark.parametrize("cancelled", [True, False])
+def test_failed_precompute(app, load_games, cancelled):
+    (game_id,) = load_games(5)
+    future = Future()
+    if cancelled:
+        future.cancel()
+    else:
+        future.set_exception(RuntimeError("the worker went away"))
+
+    with app.app_context():
+        game = db.session.get(Game, game_id)
+        game_states.invalidate(game_id)
+        key = game_states.key(game, True)
+        precomputing[key] = future
+        try:
+            # replayed by the request instead
+            state = cached_game_state(game).state
+        finally:
+            precomputing.pop(key, None)
+
+        assert state["city_data"] == compute_game_state(game, True).state["city_data"]
+        assert game_states.peek(key).state is state
@@ -0,0 +1,177 @@
+import re
+import tracemalloc
+from contextlib import contextmanager
+
+import pytest
+from flask import request_finished
+from flask_sqlalchemy.record_queries import get_recorded_queries
+
+from pandemic import db
+from pandemic.main import state, views
+from pandemic.main.cache import GameStateCache
+from pandemic.main.outlook import outlook
+from pandemic.main.state import bump_version
+from pandemic.models import Game
+
+
+@contextmanager
+def recorded_queries(app):
+    """A list of each request's query count, filled in as they finish"""
+    counts = []
+
+    def finished(sender, response, **extra):
+        counts.append(len(get_recorded_queries()))
+
+    with request_finished.connected_to(finished, app):
+        yield counts
+
+
+@pytest.fixture
+def game_id(load_games):
+    # enough games and turns that loading either per row would show
+    return load_games(*[16] * 20)[-1]
+
+
+@pytest.mark.parametrize(
+    "url, limit",
+    [
+        ("/draw/{game_id}", 3),
+        ("/history", 1),
+        ("/history/{game_id}", 5),
+        ("/replay/{game_id}/3", 2),
+    ],
+)
+def test_queries(app, game_id, url, limit):
+    client = app.test_client()
+    url = url.format(game_id=game_id)
+    # with the game's state cached, as it usually is
+    assert client.get(url).status_code == 200
+
+    with recorded_queries(app) as counts:
+        assert client.get(url).status_code == 200
+    assert counts[0] <= limit
+
+
+def test_history_memory(app, game_id):
+    client = app.test_client()
+    assert client.get("/history").status_code == 200
+
+    tracemalloc.start()
+    try:
+        assert client.get("/history").status_code == 200
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # about 80 kB, where loading every game's turns took 480 kB
+    assert peak < 200_000
+
+
+def test_history_pages(app, load_games):
+    game_ids = load_games(*[3] * 17)
+    app.config["HISTORY_PAGE_SIZE"] = 5
+    client = app.test_client()
+
+    # follow the older links to the end, newest game first
+    listed = []
+    pages = 0
+    url = "/history"
+    while url:
+        page = client.get(url).get_data(as_text=True)
+        listed += map(int, re.findall(r'/history/(\d+)">', page))
+        older = re.search(r'href="(/history\?before=\d+)"', page)
+        url = older and older.group(1)
+        pages += 1
+
+    assert listed == sorted(game_ids, reverse=True)
+    assert pages == 4
+
+
+def test_horizon(app, game_id):
+    client = app.test_client()
+    response = client.get(f"/api/game/{game_id}/horizon?turns=2")
+    assert response.status_code == 200
+
+    horizon = response.get_json()
+    assert all(0 <= p <= 1 for p in horizon["p_infected"].values())
+    assert sum(horizon["hollow_men"]) == pytest.approx(1, abs=horizon["dropped"])
+
+    max_turns = app.config["HORIZON_TURNS"]
+    url = f"/api/game/{game_id}/horizon?turns={max_turns + 1}"
+    assert client.get(url).status_code == 400
+
+
+def test_outlook(app, game_id, monkeypatch):
+    # with no time budget, only settling stops the sampling
+    app.config.update(
+        OUTLOOK_TURNS=2,
+        OUTLOOK_TIME_BUDGET=None,
+        OUTLOOK_TOLERANCE=0.02,
+        OUTLOOK_WORKERS=0,
+    )
+    client = app.test_client()
+    sampled = []
+
+    def sampling(*args, **kwargs):
+        sampled.append(kwargs)
+        return outlook(*args, **kwargs)
+
+    monkeypatch.setattr(views, "outlook", sampling)
+
+    # the page only points at the outlook, without waiting on the samples
+    response = client.get(f"/draw/{game_id}")
+    assert response.status_code == 200
+    assert f"/api/game/{game_id}/outlook".encode() in response.data
+    assert not sampled
+
+    url = f"/api/game/{game_id}/outlook"
+    result = client.get(url).get_json()
+    assert result["turns"] == 2
+    # a standard error of 0.02 takes at most 625 samples, two batches of 500
+    assert 0 < result["samples"] <= 1000
+    ps = [city["p"] for city in result["cities"]]
+    assert ps == sorted(ps, reverse=True) and all(0 < p <= 1 for p in ps)
+    assert sum(result["hollow_men"]) == pytest.approx(1)
+
+    # sampled once for the game's version
+    assert client.get(url).get_json() == result
+    assert len(sampled) == 1
+
+    app.config["OUTLOOK_TURNS"] = 0
+    assert client.get(url).status_code == 404
+
+
+def test_state_etag(app, game_id, monkeypatch):
+    client = app.test_client()
+    url = f"/api/game/{game_id}/state"
+    etag = client.get(url).headers["ETag"]
+
+    # answered from the database's version, by another worker with caches of its own
+    other = GameStateCache()
+    monkeypatch.setattr(views, "game_states", other)
+    monkeypatch.setattr(state, "game_states", other)
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+
+    with app.app_context():
+        bump_version(db.session.get(Game, game_id))
+        db.session.commit()
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_trace_whole_game(app, game_id):
+    client = app.test_client()
+    # replayed once already, so there are snapshots to start from
+    assert client.get(f"/draw/{game_id}").status_code == 200
+
+    url = f"/api/game/{game_id}/trace"
+    assert client.post(url).get_json()["tracing"]
+    try:
+        assert client.get(f"/api/game/{game_id}/state").status_code == 200
+        events = client.get(url).get_json()["events"]
+    finally:
+        client.delete(url)
+
+    played = {event["turn_num"] for event in events if event["event"] == "infect"}
+    # from the setup turn to the one the draw page started
+    assert played == set(range(-1, 17))